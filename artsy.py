@@ -2,74 +2,83 @@
 """Artsy, an artsy sort of gallery."""
 
 import os
+import time
 import shutil
 import glob
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from resizeimage import resizeimage
-from PIL import Image
-from importer import process_art_database
+from typing import Callable, Container, Dict, Iterable, Iterator, List, Optional, Tuple
+import attr
+import depgraph
+from depgraph import DependencyGraph
+from importer import ConfigFileError, process_art_database
+from manifest import BuildManifest
+from snapshot import Record, Snapshot, Submission, build_snapshot
 import models_db
 import db_helper
+import hashing
+import metrics
 from utils import LimitFilter, build_filename
 from templater import Templater
+from thumbnailer import Thumbnailer
+from watcher import get_watcher
 import utils
 
 
 templater = Templater("templates")
 
-
-def generate_thumbnail_size(img: Image, width: int, filename: str) -> None:
-    thumb = resizeimage.resize_thumbnail(img, [width, width])
-    thumb.save(filename, img.format)
-
-
-def generate_thumbnails(
-    indir: str,
-    outdir: str,
-    image: Image,
-    widths: [int],
-    do_update: bool,
-    add_touched: bool,
-    force: bool = False,
-) -> dict:
-    thumbnails = {}
-    relpath = os.path.join(indir, image.filename)
-
-    def get_path(size: str):
-        return os.path.join(
-            outdir,
-            "{slug}_{size}.{imgext}".format(
-                size=size, slug=image.slug, imgext=image.get_file_ext()
-            ),
-        )
-
-    # Copy full image file
-    fullpath = get_path("full")
-    fullhash = utils.get_hash(relpath)
-    should_do_update = do_update(fullpath, fullhash)
-    if should_do_update:
-        shutil.copy2(relpath, fullpath)
-    add_touched(fullpath)
-
-    thumbnails["full"] = os.path.basename(fullpath)
-    thumbnails["_relpath"] = relpath
-
-    # Generate actual thumbnails
-    with Image.open(relpath) as img:
-        for width in list(widths):
-            filename = get_path(width)
-            if should_do_update or not os.path.exists(filename):
-                generate_thumbnail_size(img, width, filename)
-            thumbnails[width] = os.path.basename(filename)
-            add_touched(filename)
-
-    return thumbnails
-
-
-def write_page(template: str, outfile: str, **kwargs) -> None:
-    with open(outfile, "w", encoding="utf-8") as f:
-        td = templater.generate(template, **kwargs)
-        f.write(td)
+THUMBNAIL_WIDTHS = [120, 512]
+
+# Modules deciding what pages look like, besides the templates
+RENDER_MODULES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py")
+    for name in (
+        "artsy",
+        "depgraph",
+        "markdown_cache",
+        "mdextensions",
+        "models_db",
+        "snapshot",
+        "templater",
+        "utils",
+    )
+]
+
+
+def write_page(
+    template: str,
+    outfile: str,
+    do_update: Optional[Callable[[str, str], bool]] = None,
+    **kwargs
+) -> bool:
+    """Render a page, only writing it if it differs from what's on disk.
+
+    The page is streamed into a temporary file while it's hashed, so memory
+    use doesn't depend on the size of the page.
+    """
+    hasher = hashing.new_hasher()
+    size = 0
+    written = False
+
+    def keep() -> bool:
+        nonlocal written
+        written = not do_update or do_update(outfile, hasher.hexdigest())
+        return written
+
+    start = time.perf_counter()
+    with utils.open_atomic(outfile, keep=keep) as f:
+        for chunk in templater.stream(template, **kwargs):
+            hasher.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+        metrics.observe("render:" + template, time.perf_counter() - start)
+
+    if written:
+        metrics.count("bytes_written", size)
+    return written
 
 
 def cleanup_dead_files(output_dir: str, tree_hash: dict, touched_files: list) -> None:
@@ -82,194 +91,385 @@ def cleanup_dead_files(output_dir: str, tree_hash: dict, touched_files: list) ->
         (Path(output_dir) / df).unlink()
 
 
-def generate_static_site(
-    input_dir: str, output_dir: str, base_limit: LimitFilter = None, force: bool = False
-) -> None:
-    """Output templates to filesystem."""
-    # Get data and fail on error
-    process_art_database(input_dir)
-
-    touched_files = []
-    tree_hash = {}
-
-    def add_touched(filename):
-        touched_files.append(utils.remove_parent_path(output_dir, filename))
+@attr.s
+class Pager(object):
+    """Position of a page among the pages of a listing."""
+
+    page: int = attr.ib()
+    paths: List[str] = attr.ib()
+
+    @property
+    def prev(self) -> Optional[str]:
+        return self.paths[self.page - 2] if self.page > 1 else None
+
+    @property
+    def next(self) -> Optional[str]:
+        return self.paths[self.page] if self.page < len(self.paths) else None
+
+
+def paginate(
+    submissions: Iterable[Submission],
+    page_size: Optional[int],
+    get_path: Callable[..., str],
+) -> Iterator[Tuple[str, List[Submission], Optional[Pager]]]:
+    """Split submissions into pages of page_size, yielding each page's path.
+
+    get_path(page=n) names the pages. Listings that fit on one page, or all
+    of them without a page size, get no pager.
+    """
+    submissions = list(submissions)
+    if not page_size or len(submissions) <= page_size:
+        yield get_path(page=1), submissions, None
+        return
+
+    chunks = [
+        submissions[i : i + page_size] for i in range(0, len(submissions), page_size)
+    ]
+    yield from get_pages(chunks, get_path)
+
+
+def paginate_entities(
+    entities: List[Record],
+    limit: LimitFilter,
+    page_size: Optional[int],
+    get_path: Callable[..., str],
+) -> Iterator[Tuple[str, List[Record], Optional[Pager]]]:
+    """Split a listing of entities into pages of about page_size submissions.
+
+    Templates show at most page_size submissions of each entity, so that's
+    what an entity counts for. Entities aren't split over pages.
+    """
+    if not page_size:
+        yield get_path(page=1), entities, None
+        return
+
+    chunks: List[List[Record]] = [[]]
+    shown = 0
+    for entity in entities:
+        count = min(page_size, sum(1 for _ in entity.submissions_filtered(limit)))
+        if chunks[-1] and shown + count > page_size:
+            chunks.append([])
+            shown = 0
+        chunks[-1].append(entity)
+        shown += count
+
+    if len(chunks) == 1:
+        yield get_path(page=1), entities, None
+        return
+    yield from get_pages(chunks, get_path)
+
+
+def get_pages(
+    chunks: List[list], get_path: Callable[..., str]
+) -> Iterator[Tuple[str, list, Pager]]:
+    paths = [get_path(page=page) for page in range(1, len(chunks) + 1)]
+
+    # Pages of a listing share a directory
+    names = [os.path.basename(path) for path in paths]
+    for page, (path, chunk) in enumerate(zip(paths, chunks), 1):
+        yield path, chunk, Pager(page=page, paths=names)
+
+
+@attr.s
+class RenderContext(object):
+    gallery: Snapshot = attr.ib()
+    output_dir: str = attr.ib()
+    thumbnails: dict = attr.ib()
+    thumbnailer: Thumbnailer = attr.ib()
+    do_update: Callable[[str, str], bool] = attr.ib()
+    selection: Optional[Container[Tuple[str, str]]] = attr.ib(default=None)
+    page_size: Optional[int] = attr.ib(default=None)
+
+
+@attr.s
+class RenderResult(object):
+    touched_files: List[str] = attr.ib(factory=list)
+    hashes: Dict[str, str] = attr.ib(factory=dict)
+    dependencies: Dict[str, Tuple[List[str], List[str]]] = attr.ib(factory=dict)
+    metrics: Optional[dict] = attr.ib(default=None)
+    rendered: int = attr.ib(default=0)
+    written: int = attr.ib(default=0)
+    skipped: int = attr.ib(default=0)
+    fragment_hits: int = attr.ib(default=0)
+    fragment_misses: int = attr.ib(default=0)
+
+    def merge(self, other: "RenderResult") -> None:
+        self.touched_files.extend(other.touched_files)
+        self.hashes.update(other.hashes)
+        self.dependencies.update(other.dependencies)
+        self.rendered += other.rendered
+        self.written += other.written
+        self.skipped += other.skipped
+        self.fragment_hits += other.fragment_hits
+        self.fragment_misses += other.fragment_misses
+
+
+RENDER_SECTIONS = ("artists", "tags", "species", "groups", "characters", "index")
+
+
+def render_limit(
+    context: RenderContext,
+    limit: LimitFilter,
+    sections: Iterable[str] = RENDER_SECTIONS,
+    chunk: Tuple[int, int] = (0, 1),
+) -> RenderResult:
+    """Render the pages of one limit, returning the files it produced.
+
+    chunk is (index, count): only every count-th entity starting at index is
+    rendered, and the listing pages only in the first chunk. Together the
+    chunks of a section cover it exactly once.
+    """
+    gallery = context.gallery
+    output_dir = context.output_dir
+    thumbnails = context.thumbnails
+    page_size = context.page_size
+    chunk_index, chunk_count = chunk
+    first_chunk = chunk_index == 0
+
+    result = RenderResult()
+    fragments = templater.fragments
+    fragments.refresh()
+    hits, misses = fragments.hits, fragments.misses
 
     def do_update(fullpath, fullhash):
-        return (
-            force
-            or not os.path.exists(fullpath)
-            or fullpath not in tree_hash
-            or fullhash != tree_hash[fullpath]
+        # Workers can't update the parent's manifest, so hand hashes back
+        relpath = utils.remove_parent_path(output_dir, fullpath)
+        result.hashes[relpath] = fullhash
+        return context.do_update(fullpath, fullhash)
+
+    template_files: Dict[str, List[str]] = {}
+
+    def write(template, outfile, **kwargs):
+        relpath = utils.remove_parent_path(output_dir, outfile)
+        result.touched_files.append(relpath)
+        if (
+            context.selection is not None
+            and (template, relpath) not in context.selection
+            and os.path.exists(outfile)
+        ):
+            result.skipped += 1
+            return
+
+        result.rendered += 1
+        if write_page(template, outfile, do_update=do_update, **kwargs):
+            result.written += 1
+        else:
+            result.skipped += 1
+
+        if template not in template_files:
+            filename = "{}.html".format(template)
+            template_files[template] = sorted(templater.get_dependencies(filename))
+        result.dependencies[relpath] = (
+            template_files[template],
+            sorted(depgraph.get_page_records(kwargs)),
         )
 
-    if os.path.exists(output_dir):
-        if force:
-            # Recreate the output directory
-            shutil.rmtree(output_dir, ignore_errors=True)
-
-        # Get all current hashes
-        tree_hash = utils.get_dir_hashes(output_dir)
-    else:
-        # Create output dir
-        os.makedirs(output_dir)
-
-    # Copy static files
-    static_files = glob.iglob("static/**", recursive=True)
-    for filepath in [item for item in static_files if os.path.isfile(item)]:
-        filehash = utils.get_hash(filepath)
-        newpath = utils.remove_parent_path("static", filepath)
-        outfile = os.path.join(output_dir, newpath)
-        if do_update(outfile, filehash):
-            shutil.copy2(filepath, outfile)
-        add_touched(outfile)
-
-    # Hold thumbnail paths
-    thumbnails = {}
-
-    # Loop through limits
-    # TODO: Missing index.html's for things that don't have root level content
-    for limit in db_helper.get_all_limits(base_limit, locked_vis=True):
-        submissions = []
-
-        # Hold pathing methods for views
-        pathing = {
-            "all_artists": models_db.Artist.get_path_all(limit),
-            "all_species": models_db.Species.get_path_all(limit),
-            "all_tags": models_db.Tag.get_path_all(limit),
-            "all_groups": models_db.Group.get_path_all(limit),
-            "all_characters": models_db.Character.get_path_all(limit),
-        }
-        standard_args = {"thumbnails": thumbnails, "pathing": pathing, "limit": limit}
-
+    # Hold pathing methods for views
+    pathing = {
+        "all_artists": models_db.Artist.get_path_all(limit),
+        "all_species": models_db.Species.get_path_all(limit),
+        "all_tags": models_db.Tag.get_path_all(limit),
+        "all_groups": models_db.Group.get_path_all(limit),
+        "all_characters": models_db.Character.get_path_all(limit),
+    }
+    standard_args = {
+        "thumbnails": thumbnails,
+        "pathing": pathing,
+        "limit": limit,
+        "page_size": page_size,
+    }
+
+    artists = list(gallery.get_all(gallery.artists, limit=limit))
+
+    if "artists" in sections:
         # Generate image and artist templates
-        artists = list(models_db.Artist.get_all(limit=limit))
-        for artist in artists:
-            artistdir = os.path.join(output_dir, artist.slug())
-
-            if not os.path.exists(artistdir):
-                os.makedirs(artistdir)
+        for artist in artists[chunk_index::chunk_count]:
+            submissions = list(artist.submissions_filtered(limit))
 
             # Generate image templates
-            for image in artist.submissions_filtered(limit):
+            for image in submissions:
                 outfile = os.path.join(output_dir, image.get_path(limit=limit))
 
-                # Generate thumbnails
-                thumbnails[image.slug] = generate_thumbnails(
-                    artist.path, artistdir, image, [120, 512], do_update, add_touched
-                )
-
                 # Write templated file
-                write_page(
+                write(
                     "image",
                     outfile,
                     image=image,
-                    thumbnails=thumbnails[image.slug],
+                    thumbnails=context.thumbnailer.get(image),
                     pathing=pathing,
                     limit=limit,
                 )
-                add_touched(outfile)
-                submissions.append(image)
 
             # Generate artist templates
-            artistfile = os.path.join(output_dir, artist.get_path(limit=limit))
+            pages = paginate(submissions, page_size, partial(artist.get_path, limit))
+            for path, page, pager in pages:
+                write(
+                    "artist",
+                    os.path.join(output_dir, path),
+                    artist=artist,
+                    submissions=page,
+                    pager=pager,
+                    **standard_args,
+                )
 
-            # Write templated file
-            write_page("artist", artistfile, artist=artist, **standard_args)
-            add_touched(artistfile)
+        if first_chunk:
+            # Generate all-artists template
+            pages = paginate_entities(
+                artists,
+                limit,
+                page_size,
+                partial(models_db.Artist.get_path_all, limit),
+            )
+            for path, page, pager in pages:
+                write(
+                    "artists",
+                    os.path.join(output_dir, path),
+                    artists=page,
+                    pager=pager,
+                    **standard_args,
+                )
 
-        # Generate all-artists template
-        artistsfile = os.path.join(output_dir, models_db.Artist.get_path_all(limit))
-        write_page("artists", artistsfile, artists=artists, **standard_args)
-        add_touched(artistsfile)
+    tags = list(gallery.get_all(gallery.tags, limit=limit))
 
+    if "tags" in sections:
         # Generate tag templates
-        tagsdir = os.path.join(output_dir, "_tags")
-        if not os.path.exists(tagsdir):
-            os.makedirs(tagsdir)
-
-        tags = list(models_db.Tag.get_all(limit=limit))
-        for t in tags:
-            outfile = os.path.join(output_dir, t.get_path(limit=limit))
-            write_page(
-                "tag", outfile, tag=t, **standard_args,
+        for t in tags[chunk_index::chunk_count]:
+            pages = paginate(
+                t.submissions_filtered(limit), page_size, partial(t.get_path, limit)
+            )
+            for path, page, pager in pages:
+                write(
+                    "tag",
+                    os.path.join(output_dir, path),
+                    tag=t,
+                    submissions=page,
+                    pager=pager,
+                    **standard_args,
+                )
+
+        if first_chunk:
+            # Generate all-tags template
+            pages = paginate_entities(
+                tags, limit, page_size, partial(models_db.Tag.get_path_all, limit)
             )
-            add_touched(outfile)
+            for path, page, pager in pages:
+                write(
+                    "tags",
+                    os.path.join(output_dir, path),
+                    tags=page,
+                    pager=pager,
+                    **standard_args,
+                )
 
-        # Generate all-tags template
-        tagfile = os.path.join(output_dir, models_db.Tag.get_path_all(limit))
-        write_page("tags", tagfile, tags=tags, **standard_args)
-        add_touched(tagfile)
+    species = list(gallery.get_all(gallery.species, limit=limit))
 
+    if "species" in sections:
         # Generate species templates
-        specdir = os.path.join(output_dir, "_species")
-        if not os.path.exists(specdir):
-            os.makedirs(specdir)
-
-        species = list(models_db.Species.get_all(limit=limit))
-        for spec in species:
-            outfile = os.path.join(output_dir, spec.get_path(limit=limit))
-            write_page("species", outfile, species=spec, **standard_args)
-            add_touched(outfile)
-
-        # Generate all-species template
-        specfile = os.path.join(output_dir, models_db.Species.get_path_all(limit))
-        write_page(
-            "species_all", specfile, species=species, **standard_args,
-        )
-        add_touched(specfile)
+        for spec in species[chunk_index::chunk_count]:
+            pages = paginate(
+                spec.submissions_filtered(limit),
+                page_size,
+                partial(spec.get_path, limit),
+            )
+            for path, page, pager in pages:
+                write(
+                    "species",
+                    os.path.join(output_dir, path),
+                    species=spec,
+                    submissions=page,
+                    pager=pager,
+                    **standard_args,
+                )
+
+        if first_chunk:
+            # Generate all-species template
+            pages = paginate_entities(
+                species,
+                limit,
+                page_size,
+                partial(models_db.Species.get_path_all, limit),
+            )
+            for path, page, pager in pages:
+                write(
+                    "species_all",
+                    os.path.join(output_dir, path),
+                    species=page,
+                    pager=pager,
+                    **standard_args,
+                )
 
+    groups = list(gallery.get_all(gallery.groups, limit=limit))
+
+    if "groups" in sections:
         # Generate group templates
-        groupdir = os.path.join(output_dir, "_groups")
-        if not os.path.exists(groupdir):
-            os.makedirs(groupdir)
+        for group in groups[chunk_index::chunk_count]:
+            pages = paginate(
+                group.submissions_filtered(limit),
+                page_size,
+                partial(group.get_path, limit),
+            )
+            for path, page, pager in pages:
+                write(
+                    "group",
+                    os.path.join(output_dir, path),
+                    group=group,
+                    submissions=page,
+                    pager=pager,
+                    **standard_args,
+                )
 
-        groups = list(models_db.Group.get_all(limit=limit))
-        for group in groups:
-            outfile = os.path.join(output_dir, group.get_path(limit=limit))
-            write_page("group", outfile, group=group, **standard_args)
-            add_touched(outfile)
+    characters = list(gallery.get_all(gallery.characters, limit=limit))
 
+    if "characters" in sections:
         # Generate character templates
-        chardir = os.path.join(output_dir, "_characters")
-        if not os.path.exists(chardir):
-            os.makedirs(chardir)
-
-        characters = list(models_db.Character.get_all(limit=limit))
-        for char in characters:
+        for char in characters[chunk_index::chunk_count]:
             outfile = os.path.join(output_dir, char.get_path(limit=limit))
-            write_page("character", outfile, character=char, **standard_args)
-            add_touched(outfile)
-
-        # Generate all-characters template
-        charfile = os.path.join(output_dir, models_db.Character.get_path_all(limit))
-        write_page("characters", charfile, characters=characters, **standard_args)
-        add_touched(charfile)
-
-        # # Generate JSON file
-        # jsondata = {
-        #     "data": use_artists,
-        #     "tags": use_tags,
-        #     "tag_descriptions": data.tag_key,
-        #     "groups": use_groups,
-        #     "species": use_species,
-        #     "species_descriptions": data.species_key,
-        #     "characters": use_chars,
-        #     "thumbnails": thumbnails,
-        # }
-
-        # jsonfile = os.path.join(
-        #     output_dir, build_filename("data", extension="json", limit=limit)
-        # )
-        # utils.write_json(jsonfile, jsondata, True)
-        # add_touched(jsonfile)
+            write("character", outfile, character=char, **standard_args)
+
+        if first_chunk:
+            # Generate all-characters template
+            pages = paginate_entities(
+                characters,
+                limit,
+                page_size,
+                partial(models_db.Character.get_path_all, limit),
+            )
+            for path, page, pager in pages:
+                write(
+                    "characters",
+                    os.path.join(output_dir, path),
+                    characters=page,
+                    pager=pager,
+                    **standard_args,
+                )
 
+    # # Generate JSON file
+    # jsondata = {
+    #     "data": use_artists,
+    #     "tags": use_tags,
+    #     "tag_descriptions": data.tag_key,
+    #     "groups": use_groups,
+    #     "species": use_species,
+    #     "species_descriptions": data.species_key,
+    #     "characters": use_chars,
+    #     "thumbnails": thumbnails,
+    # }
+
+    # jsonfile = os.path.join(
+    #     output_dir, build_filename("data", extension="json", limit=limit)
+    # )
+    # utils.write_json(jsonfile, jsondata, True)
+    # add_touched(jsonfile)
+
+    if "index" in sections and first_chunk:
         # Generate index file
+        submissions = [
+            image for artist in artists for image in artist.submissions_filtered(limit)
+        ]
         indexdata = {
             "pathing": pathing,
             "limit": limit,
             "thumbnails": thumbnails,
-            "submissions": submissions,
             "artists": artists,
             "tags": tags,
             "groups": groups,
@@ -277,15 +477,308 @@ def generate_static_site(
             "characters": characters,
         }
 
-        indexfile = os.path.join(output_dir, build_filename("index", limit=limit))
-        write_page("index", indexfile, **indexdata)
-        add_touched(indexfile)
+        pages = paginate(
+            submissions, page_size, partial(build_filename, "index", limit=limit)
+        )
+        for path, page, pager in pages:
+            indexfile = os.path.join(output_dir, path)
+            write("index", indexfile, submissions=page, pager=pager, **indexdata)
+
+    result.fragment_hits = fragments.hits - hits
+    result.fragment_misses = fragments.misses - misses
+    return result
+
+
+# Shared with forked render workers, which inherit it instead of unpickling it
+_render_context: Optional[RenderContext] = None
+
+
+def _render_task(task: Tuple[LimitFilter, str, Tuple[int, int]]) -> RenderResult:
+    limit, section, chunk = task
+    name = "render:{}:{}".format(utils.get_limit_name(limit), section)
+    with metrics.phase(name):
+        result = render_limit(_render_context, limit, sections=(section,), chunk=chunk)
+
+    # Measurements can't reach the parent otherwise
+    result.metrics = metrics.collect()
+    return result
+
+
+def render_limits(
+    context: RenderContext, limits: Iterable[LimitFilter], jobs: Optional[int] = None
+) -> Iterable[RenderResult]:
+    """Render every limit, spreading the pages over worker processes.
+
+    Yields the result of each unit of work in a fixed order, so the merged
+    result matches a serial build. Workers are forked so they share the
+    snapshot; where fork isn't available everything renders in-process.
+    """
+    global _render_context
+
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for limit in limits:
+            with metrics.phase("render:" + utils.get_limit_name(limit)):
+                result = render_limit(context, limit)
+            yield result
+        return
+
+    tasks = []
+    for limit in limits:
+        for section in RENDER_SECTIONS:
+            count = 1 if section == "index" else jobs
+            tasks.extend((limit, section, (i, count)) for i in range(count))
+
+    _render_context = context
+    try:
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=metrics.start_worker,
+        ) as executor:
+            yield from executor.map(_render_task, tasks)
+    finally:
+        _render_context = None
+
+
+def generate_static_site(
+    input_dir: str,
+    output_dir: str,
+    base_limit: LimitFilter = None,
+    force: bool = False,
+    jobs: Optional[int] = None,
+    incremental: bool = False,
+    batch: bool = False,
+    hash_algorithm: str = hashing.DEFAULT_ALGORITHM,
+    cache_dir: Optional[str] = None,
+    page_size: Optional[int] = None,
+    template_reload: bool = True,
+    template_modules: Optional[str] = None,
+    metrics_file: Optional[str] = None,
+    trace_file: Optional[str] = None,
+    profile_dir: Optional[str] = None,
+    memory_profile_dir: Optional[str] = None,
+) -> None:
+    """Output templates to filesystem.
+
+    Only pages that are new, or whose records or templates changed since the
+    last build according to its dependency graph, are rendered again. Where
+    the time went is written to metrics_file as a report, and to trace_file
+    as Chrome trace events. Each phase can be profiled with cProfile into
+    profile_dir, and with tracemalloc into memory_profile_dir.
+    """
+    global templater
+
+    metrics.reset(profile_dir, memory_profile_dir)
+    queries = db_helper.get_query_count()
+
+    hashing.configure(hash_algorithm, cache_dir)
+    templater = Templater(
+        templater.template_dir,
+        cache_dir=cache_dir,
+        auto_reload=template_reload,
+        module_dir=template_modules,
+    )
+
+    # Get data and fail on error
+    with metrics.phase("import"):
+        db = process_art_database(
+            input_dir,
+            incremental=incremental,
+            batch=batch,
+            jobs=jobs,
+            cache_dir=cache_dir,
+        )
+
+    # Render from a frozen copy of the data and let the database go
+    with metrics.phase("snapshot"):
+        limits = db_helper.get_all_limits(base_limit, locked_vis=True)
+        gallery = build_snapshot(limits)
+        db.remove()
+    metrics.count("sql_queries", db_helper.get_query_count() - queries)
+
+    touched_files = []
+
+    def add_touched(filename, filehash=None):
+        relpath = utils.remove_parent_path(output_dir, filename)
+        touched_files.append(relpath)
+        if filehash:
+            # Content known to be in place, so the manifest needn't hash it
+            manifest.record(relpath, filehash)
+
+    def do_update(fullpath, fullhash):
+        relpath = utils.remove_parent_path(output_dir, fullpath)
+        return (
+            force
+            or not os.path.exists(fullpath)
+            or relpath not in tree_hash
+            or fullhash != tree_hash[relpath]
+        )
+
+    if force:
+        # Recreate the output directory
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    # Create output dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Get all current hashes, only reading files changed since the last build
+    with metrics.phase("hashes"):
+        manifest = BuildManifest(output_dir, hashing.get_algorithm())
+        tree_hash = manifest.get_hashes()
+
+    # Work out which pages are out of date
+    with metrics.phase("dependencies"):
+        code_version = depgraph.get_code_version(RENDER_MODULES, page_size=page_size)
+        graph = DependencyGraph(output_dir, code_version)
+        graph.update(
+            depgraph.get_fingerprints(gallery),
+            depgraph.get_template_fingerprints(templater),
+        )
+
+    # Copy static files
+    with metrics.phase("static"):
+        static_files = glob.iglob("static/**", recursive=True)
+        for filepath in [item for item in static_files if os.path.isfile(item)]:
+            filehash = utils.get_hash(filepath)
+            newpath = utils.remove_parent_path("static", filepath)
+            outfile = os.path.join(output_dir, newpath)
+            if do_update(outfile, filehash):
+                shutil.copy2(filepath, outfile)
+                metrics.count("bytes_written", os.path.getsize(outfile))
+            add_touched(outfile, filehash)
+
+    # Hold thumbnail paths
+    thumbnails = {}
+
+    # Copy images and generate thumbnails ahead of rendering
+    with metrics.phase("thumbnails"):
+        thumbnailer = Thumbnailer(THUMBNAIL_WIDTHS, jobs=jobs)
+        for limit in limits:
+            for artist in gallery.get_all(gallery.artists, limit=limit):
+                artistdir = os.path.join(output_dir, artist.slug())
+                os.makedirs(artistdir, exist_ok=True)
+
+                for image in artist.submissions_filtered(limit):
+                    thumbnails[image.slug] = thumbnailer.add(
+                        artist.path, artistdir, image, do_update, add_touched
+                    )
+
+        for source, error in thumbnailer.run():
+            print("Failed to generate thumbnails for", source, "-", error)
+
+    # Make sure shared directories exist before pages are spread over workers
+    for dirname in ("_tags", "_species", "_groups", "_characters"):
+        os.makedirs(os.path.join(output_dir, dirname), exist_ok=True)
+
+    # Loop through limits
+    # TODO: Missing index.html's for things that don't have root level content
+    context = RenderContext(
+        gallery=gallery,
+        output_dir=output_dir,
+        thumbnails=thumbnails,
+        thumbnailer=thumbnailer,
+        do_update=do_update,
+        selection=graph,
+        page_size=page_size,
+    )
+    with metrics.phase("render"):
+        # Compile once here rather than in every worker
+        templater.load_all()
+
+        rendered = RenderResult()
+        for result in render_limits(context, limits, jobs=jobs):
+            rendered.merge(result)
+            metrics.merge(result.metrics)
+    touched_files.extend(rendered.touched_files)
+    for relpath, filehash in rendered.hashes.items():
+        manifest.record(relpath, filehash)
+    for relpath, (templates, records) in rendered.dependencies.items():
+        graph.add_page(relpath, templates, records)
+
+    with metrics.phase("cleanup"):
+        cleanup_dead_files(output_dir, tree_hash, touched_files)
+
+    with metrics.phase("save"):
+        manifest.save(touched_files)
+        graph.save(touched_files)
+        hashing.save_cache()
+        metrics.count("markdown_files_pruned", templater.markdown.prune())
+
+    metrics.count("pages_rendered", rendered.rendered)
+    metrics.count("pages_written", rendered.written)
+    metrics.count("pages_skipped", rendered.skipped)
+    metrics.count("thumbnail_cards_rendered", rendered.fragment_misses)
+    metrics.count("thumbnail_cards_reused", rendered.fragment_hits)
+    metrics.save(metrics_file, trace_file)
+
+    print(
+        "Pages rendered: {}, written: {}, unchanged: {}".format(
+            rendered.rendered, rendered.written, rendered.skipped
+        )
+    )
+    fragments = rendered.fragment_hits + rendered.fragment_misses
+    if fragments:
+        print(
+            "Thumbnails rendered: {}, reused: {} ({:.0%} hit rate)".format(
+                rendered.fragment_misses,
+                rendered.fragment_hits,
+                rendered.fragment_hits / fragments,
+            )
+        )
+
+
+def watch_static_site(input_dir: str, output_dir: str, **kwargs) -> None:
+    """Build the site, then rebuild whenever an input changes.
+
+    The database is kept between builds so only changed artist files are
+    imported again, and the dependency graph limits rendering to the pages
+    affected by the change. A failing build is reported and the next change
+    tried again, files are often saved half edited.
+    """
+
+    def build() -> None:
+        try:
+            generate_static_site(input_dir, output_dir, **kwargs)
+        except ConfigFileError as e:
+            print(e, "-", e.__cause__)
+        except Exception:
+            traceback.print_exc()
+
+    # Templates have to be picked up as they change
+    kwargs.update(template_reload=True, template_modules=None)
+    build()
+    kwargs.update(force=False, incremental=True)
+
+    watcher = get_watcher([input_dir, templater.template_dir, "static"])
+    while True:
+        print("Watching for changes...")
+        changed = watcher.wait()
 
-    cleanup_dead_files(output_dir, tree_hash, touched_files)
+        print("Rebuilding for {} changed files...".format(len(changed)))
+        build()
 
 
 if __name__ == "__main__":
     args = utils.parse_args()
     limit = utils.get_limit_from_args(args)
-    generate_static_site(args.indir, args.outdir, limit=limit, force=args.force)
+    build = watch_static_site if args.watch else generate_static_site
+    build(
+        args.indir,
+        args.outdir,
+        base_limit=limit,
+        force=args.force,
+        jobs=args.jobs,
+        incremental=args.incremental,
+        batch=args.batch,
+        hash_algorithm=args.hashAlgorithm,
+        cache_dir=args.cacheDir,
+        page_size=args.pageSize,
+        template_reload=not args.noTemplateReload,
+        template_modules=args.templateModules,
+        metrics_file=args.metrics,
+        trace_file=args.trace,
+        profile_dir=args.profile,
+        memory_profile_dir=args.profileMemory,
+    )
     print("Files written.")
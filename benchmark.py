@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Generate synthetic galleries and time building them.
+
+Each size gets a generated input tree and three builds: a full build with
+cold caches, a rebuild with nothing changed and a rebuild after one artist
+file changed. The metrics report of every build is saved, so results of
+different versions can be compared with --compare.
+"""
+
+import io
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+from datetime import datetime
+from typing import Dict, List, Optional
+import yaml
+from PIL import Image
+import artsy
+import utils
+
+
+RESULTS_VERSION = 1
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# Visibility and lockout of generated submissions, most of them public
+VISIBILITIES = [None, None, None, "private", "friends"]
+LOCKOUTS = [None, None, "nsfw"]
+
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+def write_yaml(filename: str, data: dict) -> None:
+    with open(filename, "w", encoding="utf-8") as f:
+        yaml.dump(data, f, Dumper=SafeDumper, sort_keys=False)
+
+
+def get_image_data(color: tuple) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def generate_gallery(
+    path: str,
+    submissions: int,
+    artists: Optional[int] = None,
+    characters: int = 20,
+    species: int = 10,
+    tags: int = 200,
+    groups: int = 5,
+    seed: int = 0,
+) -> None:
+    """Write an input tree with a metadata file and artist directories.
+
+    Submissions are spread evenly over the artists, each with a small image,
+    a handful of tags, aliases, species, groups and characters, and a mix of
+    visibilities and lockouts.
+    """
+    rng = random.Random(seed)
+    artists = artists or max(1, submissions // 50)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    species_names = ["species{}".format(i) for i in range(species)]
+    tag_names = ["tag{}".format(i) for i in range(tags)]
+    aliases = {"alias{}".format(i): tag_names[i] for i in range(0, tags, 10)}
+
+    metadata_characters = {}
+    forms = []
+    for i in range(characters):
+        char_id = "char{}".format(i)
+        char_species = {}
+        for name in rng.sample(species_names, min(2, species)):
+            char_species[name] = {
+                "description": "{} as a *{}*".format(char_id, name),
+                "subforms": {"feral": None},
+            }
+            forms.extend(
+                ["{}#{}".format(char_id, name), "{}#{}#feral".format(char_id, name)]
+            )
+        metadata_characters[char_id] = {
+            "name": "Character {}".format(i),
+            "description": "Generated character **{}**".format(i),
+            "species": char_species,
+        }
+
+    write_yaml(
+        os.path.join(path, ".metadata.yaml"),
+        {
+            "characters": metadata_characters,
+            "species_softname": {name: name.title() for name in species_names},
+            "tag_aliases": aliases,
+            "tag_descriptions": {
+                name: "About *{}*".format(name) for name in tag_names[::20]
+            },
+            "tag_softname": {name: name.upper() for name in tag_names[::25]},
+        },
+    )
+
+    tag_choices = tag_names + list(aliases)
+    number = 0
+    for a in range(artists):
+        artist_dir = os.path.join(path, "artist{}".format(a))
+        os.makedirs(artist_dir)
+        image = get_image_data((a * 37 % 256, a * 91 % 256, 128))
+
+        # Spread the remainder over the first artists
+        count = submissions // artists + (1 if a < submissions % artists else 0)
+        files = []
+        for _ in range(count):
+            number += 1
+            filename = "image{}.png".format(number)
+            with open(os.path.join(artist_dir, filename), "wb") as f:
+                f.write(image)
+
+            submission_tags = rng.sample(tag_choices, min(6, len(tag_choices)))
+            submission_tags.append("species#" + rng.choice(species_names))
+            if groups and rng.random() < 0.3:
+                submission_tags.append("group#group{}".format(rng.randrange(groups)))
+
+            entry = {
+                "filename": filename,
+                "title": "Image {}".format(number),
+                "slug": "image{}".format(number),
+                "date": int(
+                    "20{:02}{:02}{:02}".format(
+                        rng.randrange(10, 20), rng.randint(1, 12), rng.randint(1, 28)
+                    )
+                ),
+                "tags": submission_tags,
+                "characters": rng.sample(forms, min(rng.randint(0, 2), len(forms))),
+                "description": "Image *{}* of <c:char{}>".format(
+                    number, rng.randrange(characters) if characters else 0
+                ),
+            }
+            visibility = rng.choice(VISIBILITIES)
+            lockout = rng.choice(LOCKOUTS)
+            if visibility:
+                entry["visibility"] = visibility
+            if lockout:
+                entry["lockout"] = lockout
+            files.append(entry)
+
+        write_yaml(
+            os.path.join(artist_dir, ".art.yaml"),
+            {"artist": {"name": "Artist {}".format(a)}, "files": files},
+        )
+
+
+def change_artist_file(path: str) -> None:
+    """Change one submission title of the first artist."""
+    filename = os.path.join(path, "artist0", ".art.yaml")
+    with open(filename, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+    data["files"][0]["title"] += " (changed)"
+    write_yaml(filename, data)
+
+
+def run_build(report_file: str, input_dir: str, output_dir: str, **kwargs) -> dict:
+    """Build the site, returning its metrics report."""
+    start = time.perf_counter()
+    artsy.generate_static_site(
+        input_dir, output_dir, metrics_file=report_file, **kwargs
+    )
+    wall = time.perf_counter() - start
+
+    with open(report_file, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    report["wall"] = wall
+    return report
+
+
+def run_size(
+    work_dir: str, size: int, jobs: Optional[int] = None, batch: bool = False
+) -> dict:
+    input_dir = os.path.join(work_dir, "input-{}".format(size))
+    output_dir = os.path.join(work_dir, "output-{}".format(size))
+    cache_dir = os.path.join(work_dir, "cache-{}".format(size))
+
+    start = time.perf_counter()
+    generate_gallery(input_dir, size)
+    generated = time.perf_counter() - start
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    settings = {"jobs": jobs, "batch": batch, "cache_dir": cache_dir}
+
+    def build(name: str, **kwargs) -> dict:
+        print("Benchmarking {} build of {} submissions...".format(name, size))
+        report_file = os.path.join(work_dir, "{}-{}.json".format(name, size))
+        kwargs.update(settings)
+        return run_build(report_file, input_dir, output_dir, **kwargs)
+
+    builds = {"full": build("full", force=True)}
+    builds["noop"] = build("noop", incremental=True)
+    change_artist_file(input_dir)
+    builds["one_change"] = build("one_change", incremental=True)
+
+    return {"generate": generated, "builds": builds}
+
+
+def get_timings(report: dict) -> Dict[str, float]:
+    """Wall time of a build and of each of its phases."""
+    timings = {"total": report["wall"]}
+    timings.update((name, phase["wall"]) for name, phase in report["phases"].items())
+    return timings
+
+
+def compare(baseline: dict, results: dict) -> None:
+    """Print the wall times of two sets of results side by side."""
+    for size, current in results["results"].items():
+        previous = baseline["results"].get(size)
+        if not previous:
+            continue
+
+        for name, report in current["builds"].items():
+            if name not in previous["builds"]:
+                continue
+
+            print("{} submissions, {} build:".format(size, name))
+            old = get_timings(previous["builds"][name])
+            new = get_timings(report)
+            for phase in sorted(old.keys() & new.keys()):
+                change = (new[phase] - old[phase]) / old[phase] if old[phase] else 0
+                print(
+                    "  {:<32} {:>9.3f}s {:>9.3f}s {:>+8.1%}".format(
+                        phase, old[phase], new[phase], change
+                    )
+                )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Time builds of synthetic galleries of several sizes"
+    )
+    parser.add_argument(
+        "--sizes",
+        help="Comma separated numbers of submissions",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+    )
+    parser.add_argument(
+        "--workDir",
+        help="Directory for generated galleries and their output",
+        default=".artsy-bench",
+        metavar="WORK_DIR",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes (defaults to the CPU count)",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument("--batch", help="Bulk insert artist files", action="store_true")
+    parser.add_argument(
+        "--generateOnly",
+        help="Only generate the galleries, for use with artsy.py",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Results file",
+        default="benchmark.json",
+        metavar="FILENAME",
+    )
+    parser.add_argument(
+        "--compare",
+        help="Earlier results file to compare with",
+        default=None,
+        metavar="FILENAME",
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    os.makedirs(args.workDir, exist_ok=True)
+
+    if args.generateOnly:
+        for size in sizes:
+            generate_gallery(os.path.join(args.workDir, "input-{}".format(size)), size)
+        return
+
+    results = {
+        "version": RESULTS_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "jobs": args.jobs,
+        "batch": args.batch,
+        "results": {
+            str(size): run_size(args.workDir, size, jobs=args.jobs, batch=args.batch)
+            for size in sizes
+        },
+    }
+    utils.write_atomic(args.output, json.dumps(results, indent=2).encode("utf-8"))
+
+    for size, result in results["results"].items():
+        builds = result["builds"]
+        print(
+            "{} submissions: full {:.2f}s, no-op {:.2f}s, one change {:.2f}s".format(
+                size,
+                builds["full"]["wall"],
+                builds["noop"]["wall"],
+                builds["one_change"]["wall"],
+            )
+        )
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("version") != RESULTS_VERSION:
+            raise RuntimeError("Can't compare with results from another version.")
+        compare(baseline, results)
+
+
+if __name__ == "__main__":
+    main()
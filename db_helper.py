@@ -1,6 +1,76 @@
 from typing import List
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, selectinload
 from utils import LimitFilter
-from models_db import Submission
+from models_db import (
+    Artist,
+    Submission,
+    Species,
+    Tag,
+    Group,
+    Character,
+    CharacterForm,
+)
+
+
+class QueryCounter(object):
+    """Count the SQL statements sent to the database."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+query_counter = QueryCounter()
+
+
+def watch_queries(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", query_counter)
+
+
+def get_query_count() -> int:
+    return query_counter.count
+
+
+def preload_render_data() -> List[list]:
+    """Load every row and relationship the templates read, up front.
+
+    Rendering then works from the session's identity map instead of lazy
+    loading each relationship, one row at a time. Collections are loaded in
+    batches of 500 rows, so the number of queries only grows by one per batch.
+    The identity map only holds weak references, so keep the returned rows
+    alive for as long as they're needed.
+    """
+    return [
+        Artist.query.options(selectinload(Artist.submissions)).all(),
+        Submission.query.options(
+            joinedload(Submission.artist),
+            selectinload(Submission.characters),
+            selectinload(Submission.tags),
+            selectinload(Submission.species),
+            selectinload(Submission.groups),
+        ).all(),
+        Species.query.options(
+            selectinload(Species.forms), selectinload(Species.submissions)
+        ).all(),
+        Tag.query.options(
+            joinedload(Tag.parent),
+            selectinload(Tag.children),
+            selectinload(Tag.submissions),
+        ).all(),
+        Group.query.options(selectinload(Group.submissions)).all(),
+        Character.query.options(selectinload(Character.forms)).all(),
+        CharacterForm.query.options(
+            joinedload(CharacterForm.parent),
+            joinedload(CharacterForm.character),
+            joinedload(CharacterForm.species),
+            selectinload(CharacterForm.children),
+            selectinload(CharacterForm.submissions),
+        ).all(),
+    ]
 
 
 def get_all_limits(
@@ -9,7 +79,7 @@ def get_all_limits(
     # Get all permutations of visibilities and lockouts and return Limits for them
     # TODO: Non-root should actually include other content if settings say so
     # Also we need some way to allow a lockout to include all visibilities [explicit config?]
-    def unique_limit(f: Submission) -> LimitFilter:
+    def unique_limit(f) -> LimitFilter:
         return LimitFilter(
             visibility=f.visibility,
             visibilityOnly=locked_vis,
@@ -17,6 +87,8 @@ def get_all_limits(
             lockoutOnly=locked_vis,
         )
 
-    submissions = Submission.query.all()
-    limits = set(map(unique_limit, submissions))
+    pairs = Submission.query.with_entities(
+        Submission.visibility, Submission.lockout
+    ).distinct()
+    limits = set(map(unique_limit, pairs))
     return limits
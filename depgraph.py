@@ -0,0 +1,308 @@
+"""Which records and templates each output page was rendered from."""
+
+import os
+import json
+import argparse
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import hashing
+import snapshot
+import utils
+from manifest import BUILD_FILE_PREFIX
+from snapshot import Record, Snapshot
+from templater import Templater
+
+
+GRAPH_NAME = BUILD_FILE_PREFIX + "depgraph"
+GRAPH_VERSION = 1
+
+# Snapshot attribute holding each kind of record
+LISTINGS = {
+    snapshot.Artist: "artists",
+    snapshot.Submission: "submissions",
+    snapshot.Species: "species",
+    snapshot.Tag: "tags",
+    snapshot.Group: "groups",
+    snapshot.Character: "characters",
+    snapshot.CharacterForm: "character_forms",
+}
+
+# Slots left out of fingerprints: derived from the visibility fields and the
+# build's limits, or database IDs handed out again on every import
+UNFINGERPRINTED = ("mask", "limit_index", "submission_id")
+
+# Related records a page shows along with a record, and whether the page
+# shows their submissions too
+SHOWN_RELATIONS = {
+    snapshot.Submission: (("artist", "tags", "species", "groups", "characters"), False),
+    snapshot.Character: (("forms",), True),
+}
+
+# Related records whose names are part of a record's name, wherever it's shown
+NAMED_RELATIONS = {
+    snapshot.CharacterForm: ("species", "parent"),
+}
+
+
+def get_key(record: Record) -> str:
+    """Name a record in a way that survives the database being rebuilt."""
+    if isinstance(record, snapshot.Submission):
+        # Submission IDs are handed out again on every import
+        return "submission:{}/{}".format(record.artist.slug(), record.slug)
+    if isinstance(record, snapshot.Artist):
+        return "artist:{}".format(record.name)
+    if isinstance(record, snapshot.Species):
+        return "species:{}".format(record.species_name)
+    if isinstance(record, snapshot.Tag):
+        return "tag:{}".format(record.tag_id)
+    if isinstance(record, snapshot.Group):
+        return "group:{}".format(record.group_name)
+    if isinstance(record, snapshot.Character):
+        return "character:{}".format(record.name)
+    return "form:{}".format(record.form_id)
+
+
+def get_fingerprint(record: Record) -> str:
+    """Hash everything about a record, naming related records by key."""
+    values = {}
+    for cls in type(record).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if name in UNFINGERPRINTED:
+                continue
+
+            value = getattr(record, name)
+            if isinstance(value, Record):
+                value = get_key(value)
+            elif isinstance(value, tuple):
+                value = [get_key(v) if isinstance(v, Record) else v for v in value]
+            values[name] = value
+
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashing.get_data_hash(data.encode("utf-8"), "blake2b")
+
+
+def get_visibility(record: Record) -> List[Tuple[str, str, int]]:
+    """Count a record's submissions under each visibility and lockout pair."""
+    if isinstance(record, snapshot.Submission):
+        submissions = (record,)
+    elif isinstance(record, snapshot.Character):
+        submissions = tuple(s for form in record.forms for s in form.submissions)
+    else:
+        submissions = record.submissions
+
+    counts: Dict[Tuple[str, str], int] = {}
+    for s in submissions:
+        pair = (s.visibility or "", s.lockout or "")
+        counts[pair] = counts.get(pair, 0) + 1
+    return sorted(pair + (n,) for pair, n in counts.items())
+
+
+def get_fingerprints(gallery: Snapshot) -> Dict[str, str]:
+    """Fingerprint every record, and every kind's list of records."""
+    fingerprints = {}
+    for name in LISTINGS.values():
+        records = getattr(gallery, name)
+        keys = [get_key(record) for record in records]
+        fingerprints.update(
+            (key, get_fingerprint(record)) for key, record in zip(keys, records)
+        )
+
+        # Listings change when records come and go, are reordered, or when
+        # they start or stop being visible under some limit. Listings split
+        # into pages by submission counts also change when those do.
+        listing = [(key, get_visibility(r)) for key, r in zip(keys, records)]
+        data = json.dumps(listing).encode("utf-8")
+        fingerprints[name] = hashing.get_data_hash(data, "blake2b")
+
+    return fingerprints
+
+
+def get_template_fingerprints(templater: Templater) -> Dict[str, str]:
+    return {
+        name: hashing.get_data_hash(templater.get_source(name).encode(), "blake2b")
+        for name in templater.list_templates()
+    }
+
+
+def get_page_records(kwargs: dict) -> Set[str]:
+    """Find the records a page shows, given the arguments it's rendered with."""
+    found: Set[str] = set()
+
+    def add(record: Record, expand: bool = True) -> None:
+        found.add(get_key(record))
+        for name in NAMED_RELATIONS.get(type(record), ()):
+            related = getattr(record, name)
+            if related is not None:
+                add(related, False)
+        if not expand:
+            return
+
+        names, expand_related = SHOWN_RELATIONS.get(type(record), ((), False))
+        for name in names:
+            value = getattr(record, name)
+            for related in value if isinstance(value, tuple) else (value,):
+                if related is not None:
+                    add(related, expand_related)
+
+        # All submissions, not just the visible ones, so that one becoming
+        # visible marks the page as dirty too
+        for submission in getattr(record, "submissions", ()):
+            add(submission, False)
+
+    for value in kwargs.values():
+        if isinstance(value, Record):
+            add(value)
+        elif isinstance(value, (list, tuple)) and value:
+            if isinstance(value[0], Record):
+                for record in value:
+                    add(record)
+
+                # Pages listing a kind of record depend on which exist.
+                # Submission lists come from records already covered above.
+                if not isinstance(value[0], snapshot.Submission):
+                    found.add(LISTINGS[type(value[0])])
+
+    return found
+
+
+class DependencyGraph(object):
+    """Records and template files each page was rendered from.
+
+    Kept in the output directory with fingerprints of the records and
+    templates as they were, so the next build can tell which pages changed.
+    Works as a selection of pages to render: a page is in it when it's new
+    or anything it was rendered from changed.
+    """
+
+    def __init__(self, output_dir: str, code_version: Optional[str] = None):
+        self.path = os.path.join(output_dir, GRAPH_NAME)
+        self.code_version = code_version
+
+        # Relative path: (template files, record keys)
+        self.pages: Dict[str, Tuple[List[str], List[str]]] = {}
+        self.records: Dict[str, str] = {}
+        self.templates: Dict[str, str] = {}
+
+        self.changed_records: Set[str] = set()
+        self.changed_templates: Set[str] = set()
+
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        # Output from other code may have been rendered differently, unless
+        # the graph is only being read
+        if data.get("version") == GRAPH_VERSION and self.code_version in (
+            None,
+            data.get("code"),
+        ):
+            self.pages = {k: tuple(v) for k, v in data["pages"].items()}
+            self.records = data["records"]
+            self.templates = data["templates"]
+
+    def update(self, records: Dict[str, str], templates: Dict[str, str]) -> None:
+        """Compare new fingerprints with the stored ones and keep the new ones."""
+
+        def changed(old: Dict[str, str], new: Dict[str, str]) -> Set[str]:
+            return {k for k in old.keys() | new.keys() if old.get(k) != new.get(k)}
+
+        self.changed_records = changed(self.records, records)
+        self.changed_templates = changed(self.templates, templates)
+        self.records = records
+        self.templates = templates
+
+    def is_dirty(self, relpath: str) -> bool:
+        if relpath not in self.pages:
+            return True
+
+        templates, records = self.pages[relpath]
+        return not (
+            self.changed_templates.isdisjoint(templates)
+            and self.changed_records.isdisjoint(records)
+        )
+
+    def __contains__(self, page: Tuple[str, str]) -> bool:
+        template, relpath = page
+        return self.is_dirty(relpath)
+
+    def add_page(self, relpath: str, templates: List[str], records: List[str]):
+        self.pages[relpath] = (templates, records)
+
+    def get_dependents(self, key: str) -> List[str]:
+        """Find the pages rendered from a record key or template file."""
+        return sorted(
+            relpath
+            for relpath, (templates, records) in self.pages.items()
+            if key in templates or key in records
+        )
+
+    def save(self, touched_files: Iterable[str]) -> None:
+        # Forget pages that weren't produced this time
+        touched = set(touched_files)
+        self.pages = {k: v for k, v in self.pages.items() if k in touched}
+
+        data = {
+            "version": GRAPH_VERSION,
+            "code": self.code_version,
+            "records": self.records,
+            "templates": self.templates,
+            "pages": self.pages,
+        }
+        with utils.open_atomic(self.path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+
+def get_code_version(filenames: Iterable[str], **settings) -> str:
+    """Hash the modules and settings that decide what pages look like."""
+    hasher = hashing.new_hasher("blake2b")
+    for filename in sorted(filenames):
+        with open(filename, "rb") as f:
+            hasher.update(f.read())
+    hasher.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="List the pages depending on records or templates"
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        help="Output directory",
+        default="output",
+        metavar="OUTPUT_DIR",
+    )
+    parser.add_argument(
+        "keys",
+        help="Record keys like tag:cute or artist:Name, or template files",
+        nargs="*",
+        metavar="KEY",
+    )
+    args = parser.parse_args(argv)
+
+    graph = DependencyGraph(args.outdir)
+    if not graph.pages:
+        raise RuntimeError("No dependency graph in {}.".format(args.outdir))
+
+    if not args.keys:
+        # List everything pages can depend on
+        keys = set()
+        for templates, records in graph.pages.values():
+            keys.update(templates)
+            keys.update(records)
+        for key in sorted(keys):
+            print(key)
+        return
+
+    for key in args.keys:
+        for relpath in graph.get_dependents(key):
+            print(relpath)
+
+
+if __name__ == "__main__":
+    main()
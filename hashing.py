@@ -0,0 +1,152 @@
+"""Streaming file hashes, cached by stat data within and across builds."""
+
+import os
+import json
+import hashlib
+import binascii
+from typing import Dict, Optional, Tuple
+import utils
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+CHUNK_SIZE = 1024 * 1024
+CACHE_NAME = "hashes.json"
+CACHE_VERSION = 1
+DEFAULT_ALGORITHM = "crc32"
+
+
+class Crc32Hasher(object):
+    """CRC32 with the update/hexdigest interface of hashlib objects."""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes) -> None:
+        self.value = binascii.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return "%08X" % (self.value & 0xFFFFFFFF)
+
+
+ALGORITHMS = {
+    "crc32": Crc32Hasher,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash is not None:
+    ALGORITHMS["xxhash"] = xxhash.xxh64
+
+
+def new_hasher(algorithm: Optional[str] = None):
+    """Start an incremental hash, for content that's produced in pieces."""
+    return ALGORITHMS[algorithm or _algorithm]()
+
+
+def get_data_hash(data: bytes, algorithm: Optional[str] = None) -> str:
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def hash_file(path: str, algorithm: Optional[str] = None) -> str:
+    """Hash a file a chunk at a time, so memory use doesn't grow with its size."""
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size])
+    return hasher.hexdigest()
+
+
+class HashCache(object):
+    """File hashes keyed by path, size, mtime, inode and algorithm.
+
+    A file that was replaced or modified changes at least one of these, so a
+    matching entry can be trusted without reading the file again. When given
+    a directory the cache is kept there between builds.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.path = os.path.join(cache_dir, CACHE_NAME) if cache_dir else None
+
+        # Absolute path: (size, mtime_ns, inode, algorithm, hash)
+        self.entries: Dict[str, Tuple[int, int, int, str, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+        if self.path:
+            self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == CACHE_VERSION:
+            self.entries = {k: tuple(v) for k, v in data["files"].items()}
+
+    def save(self) -> None:
+        if not self.path:
+            return
+
+        # Forget files that are gone so the cache doesn't grow forever
+        files = {k: v for k, v in self.entries.items() if os.path.exists(k)}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with utils.open_atomic(self.path, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "files": files}, f)
+
+    def get_hash(self, path: str, algorithm: Optional[str] = None) -> Optional[str]:
+        algorithm = algorithm or _algorithm
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino, algorithm)
+        entry = self.entries.get(path)
+        if entry and entry[:4] == key:
+            self.hits += 1
+            return entry[4]
+
+        self.misses += 1
+        filehash = hash_file(path, algorithm)
+        self.entries[path] = key + (filehash,)
+        return filehash
+
+
+# Build-wide settings, inherited by forked workers
+
+_algorithm = DEFAULT_ALGORITHM
+_cache = HashCache()
+
+
+def configure(algorithm: str = DEFAULT_ALGORITHM, cache_dir: Optional[str] = None):
+    """Select the hash algorithm and where the hash cache is persisted."""
+    global _algorithm, _cache
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unknown hash algorithm: {}".format(algorithm))
+    _algorithm = algorithm
+    _cache = HashCache(cache_dir)
+
+
+def get_algorithm() -> str:
+    return _algorithm
+
+
+def get_file_hash(path: str) -> Optional[str]:
+    return _cache.get_hash(path)
+
+
+def save_cache() -> None:
+    _cache.save()
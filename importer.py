@@ -2,32 +2,111 @@ import yaml
 import cattr
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Dict
-from sqlalchemy import create_engine
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import create_engine, func
 from sqlalchemy.orm import scoped_session, sessionmaker
 import models_file
 import models_db
+import db_helper
+import metrics
+import utils
+from parse_cache import ParseCache
+
+
+# Use libyaml when it's available, it parses several times faster
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 # Database
 
 
-def open_database() -> scoped_session:
-    # TODO: Only make this create the whole thing if it needs to
+def open_database(rebuild: bool = True) -> scoped_session:
     engine = create_engine("sqlite:///metadata.sqlite")
+    db_helper.watch_queries(engine)
     db_session = scoped_session(
         sessionmaker(autocommit=False, autoflush=False, bind=engine)
     )
     Base = models_db.Base
 
     Base.query = db_session.query_property()
-    Base.metadata.drop_all(bind=engine)  # TODO: Don't
-    Base.metadata.create_all(bind=engine)
+    if rebuild:
+        reset_database(db_session)
+    else:
+        Base.metadata.create_all(bind=engine)
 
     return db_session
 
 
+def reset_database(db: scoped_session) -> None:
+    # Release any open read transaction so the drop isn't blocked
+    db.close()
+
+    engine = db.get_bind()
+    models_db.Base.metadata.drop_all(bind=engine)
+    models_db.Base.metadata.create_all(bind=engine)
+
+
+def source_file_changed(record: Optional[models_db.SourceFile], path: str) -> bool:
+    """Check whether a source file changed since its record was imported."""
+    if not record:
+        return True
+
+    stat = os.stat(path)
+    if record.mtime == stat.st_mtime_ns and record.size == stat.st_size:
+        return False
+
+    if record.hash != utils.get_hash(path):
+        return True
+
+    # Contents are the same, only the stat data moved
+    record.mtime = stat.st_mtime_ns
+    record.size = stat.st_size
+    return False
+
+
+def record_source_file(
+    db: scoped_session, path: str, artist_name: Optional[str] = None
+) -> None:
+    stat = os.stat(path)
+    db.merge(
+        models_db.SourceFile(
+            path=path,
+            mtime=stat.st_mtime_ns,
+            size=stat.st_size,
+            hash=utils.get_hash(path),
+            artist_name=artist_name,
+        )
+    )
+
+
+def delete_artist(db: scoped_session, artist_name: str) -> None:
+    """Remove an artist along with their submissions and links."""
+    submission_ids = db.query(models_db.Submission.submission_id).filter(
+        models_db.Submission.artist_id == artist_name
+    )
+
+    for table in (
+        models_db.submission_tag_association_table,
+        models_db.submission_group_association_table,
+        models_db.submission_species_association_table,
+        models_db.submission_form_association_table,
+    ):
+        db.execute(table.delete().where(table.c.submission_id.in_(submission_ids)))
+
+    db.execute(
+        models_db.Submission.__table__.delete().where(
+            models_db.Submission.artist_id == artist_name
+        )
+    )
+    db.execute(
+        models_db.Artist.__table__.delete().where(models_db.Artist.name == artist_name)
+    )
+    db.expire_all()
+
+
 def upsert_tag(
     db: scoped_session,
     tag_id: str,
@@ -53,7 +132,7 @@ def upsert_tag(
             parent=parent_tag,
         )
         db.add(tag_row)
-        db.commit()
+        db.flush()
 
     return tag_row
 
@@ -81,7 +160,7 @@ def upsert_species(
             species_name=species_name, description=description, softname=softname
         )
         db.add(species_row)
-        db.commit()
+        db.flush()
 
     return species_row
 
@@ -109,7 +188,7 @@ def upsert_group(
             group_name=group_name, description=description, softname=softname
         )
         db.add(group_row)
-        db.commit()
+        db.flush()
 
     return group_row
 
@@ -215,12 +294,16 @@ def insert_artist_file(
     file_path: str,
     aliases: Dict[str, str],
 ):
+    """Add an artist file's rows, leaving the commit to the caller.
+
+    Nothing is committed along the way, so a file that fails halfway can
+    be rolled back as a whole.
+    """
     artist = artist_file.artist
     artist_row = models_db.Artist(
         name=artist.name, links=cattr.unstructure(artist.links), path=file_path,
     )
     db.add(artist_row)
-    db.commit()
 
     files = artist_file.files
     for f in files:
@@ -248,7 +331,8 @@ def insert_artist_file(
                 tn = aliases[tn]
 
             if tn.startswith("species#"):
-                species.add(tn)
+                # Same key as character forms use, so it's only linked once
+                species.add(tn[8:])
                 continue
 
             if tn.startswith("group#"):
@@ -272,7 +356,175 @@ def insert_artist_file(
             file_row.groups.append(upsert_group(db, gn))
 
         db.add(file_row)
-        db.commit()
+        db.flush()
+
+
+class BulkImporter(object):
+    """Insert artist files without per-row lookups or commits.
+
+    Existing tags, species, groups and character forms are preloaded once,
+    and each artist file is written as a handful of executemany inserts in
+    the caller's transaction.
+    """
+
+    def __init__(self, db: scoped_session):
+        self.db = db
+
+        self.tags = {t.tag_id for t in db.query(models_db.Tag.tag_id)}
+        self.species = {
+            s.species_name for s in db.query(models_db.Species.species_name)
+        }
+        self.groups = {g.group_name for g in db.query(models_db.Group.group_name)}
+        self.forms = {
+            f.form_id: f.species_name
+            for f in db.query(
+                models_db.CharacterForm.form_id, models_db.CharacterForm.species_name
+            )
+        }
+
+        last_id = db.query(func.max(models_db.Submission.submission_id)).scalar()
+        self.next_submission_id = (last_id or 0) + 1
+
+    def _add_tag(self, tag_id: str, rows: List[dict]) -> None:
+        if tag_id in self.tags:
+            return
+
+        split = tag_id.split("#")
+        parent_id = None
+        if len(split) > 1:
+            parent_id = "#".join(split[:-1])
+            self._add_tag(parent_id, rows)
+
+        self.tags.add(tag_id)
+        rows.append(
+            {
+                "tag_id": tag_id,
+                "tag_name": split[-1:][0],
+                "description": None,
+                "softname": None,
+                "parent_id": parent_id,
+            }
+        )
+
+    def _add_species(self, species_name: str, rows: List[dict]) -> None:
+        if "#" in species_name:
+            raise RuntimeError("Found hash in species name '{}'".format(species_name))
+
+        if species_name not in self.species:
+            self.species.add(species_name)
+            rows.append(
+                {"species_name": species_name, "description": None, "softname": None}
+            )
+
+    def _add_group(self, group_name: str, rows: List[dict]) -> None:
+        if "#" in group_name:
+            raise RuntimeError("Found hash in group name '{}'".format(group_name))
+
+        if group_name not in self.groups:
+            self.groups.add(group_name)
+            rows.append(
+                {"group_name": group_name, "description": None, "softname": None}
+            )
+
+    def insert_artist_file(
+        self,
+        artist_file: models_file.ArtistFile,
+        file_path: str,
+        aliases: Dict[str, str],
+    ) -> None:
+        artist = artist_file.artist
+
+        new_tags: List[dict] = []
+        new_species: List[dict] = []
+        new_groups: List[dict] = []
+        submission_rows: List[dict] = []
+        tag_links: List[dict] = []
+        species_links: List[dict] = []
+        group_links: List[dict] = []
+        form_links: List[dict] = []
+
+        for f in artist_file.files:
+            submission_id = self.next_submission_id
+            self.next_submission_id += 1
+
+            submission_rows.append(
+                {
+                    "submission_id": submission_id,
+                    "submission_type": "image",
+                    "artist_id": artist.name,
+                    "filename": f.filename,
+                    "title": f.title,
+                    "slug": f.slug,
+                    "date": datetime.strptime(str(f.date), "%Y%m%d"),
+                    "description": f.description,
+                    "visibility": f.visibility,
+                    "lockout": f.lockout,
+                    "sequence": cattr.unstructure(f.sequence),
+                    "my_links": cattr.unstructure(f.my_links),
+                    "artist_links": cattr.unstructure(f.artist_links),
+                }
+            )
+
+            tags: List[str] = []
+            species: List[str] = []
+            groups: List[str] = []
+
+            def add_unique(items: List[str], item: str) -> None:
+                if item not in items:
+                    items.append(item)
+
+            for tn in f.tags:
+                if aliases and tn in aliases:
+                    tn = aliases[tn]
+
+                if tn.startswith("species#"):
+                    add_unique(species, tn[8:])
+                elif tn.startswith("group#"):
+                    add_unique(groups, tn[6:])
+                else:
+                    add_unique(tags, tn)
+
+            for c in f.characters:
+                if c not in self.forms:
+                    raise RuntimeError("Undefined character '{}'".format(c))
+                form_links.append({"submission_id": submission_id, "form_id": c})
+                add_unique(species, self.forms[c])
+
+            for tn in tags:
+                self._add_tag(tn, new_tags)
+                tag_links.append({"submission_id": submission_id, "tag_id": tn})
+
+            for sn in species:
+                self._add_species(sn, new_species)
+                species_links.append(
+                    {"submission_id": submission_id, "species_name": sn}
+                )
+
+            for gn in groups:
+                self._add_group(gn, new_groups)
+                group_links.append({"submission_id": submission_id, "group_name": gn})
+
+        self.db.execute(
+            models_db.Artist.__table__.insert(),
+            {
+                "name": artist.name,
+                "links": cattr.unstructure(artist.links),
+                "path": file_path,
+            },
+        )
+
+        for table, rows in (
+            (models_db.Tag.__table__, new_tags),
+            (models_db.Species.__table__, new_species),
+            (models_db.Group.__table__, new_groups),
+            (models_db.Submission.__table__, submission_rows),
+            (models_db.submission_tag_association_table, tag_links),
+            (models_db.submission_species_association_table, species_links),
+            (models_db.submission_group_association_table, group_links),
+            (models_db.submission_form_association_table, form_links),
+        ):
+            if rows:
+                self.db.execute(table.insert(), rows)
 
 
 # Metadata files
@@ -296,11 +548,48 @@ class ConfigFileError(Exception):
 def load_artist_file(filename: str) -> models_file.ArtistFile:
     """Load an artist file."""
     with open(filename, "r", encoding="utf-8") as f:
-        obj = yaml.load(f.read(), Loader=yaml.SafeLoader)
+        obj = yaml.load(f.read(), Loader=SafeLoader)
         obj = cattr.structure(obj, models_file.ArtistFile)
         return obj
 
 
+def load_artist_files(
+    filenames: List[str], jobs: Optional[int] = None, cache: ParseCache = None
+) -> Iterator[Tuple[str, Callable[[], models_file.ArtistFile]]]:
+    """Load artist files across a process pool, yielding them in order.
+
+    Each filename comes with a function returning the loaded file or raising
+    its error, so errors can still be reported against the right file. Files
+    found in the cache aren't parsed again.
+    """
+    cache = cache or ParseCache()
+    cached = {filename: cache.get(filename) for filename in filenames}
+    missing = [filename for filename in filenames if cached[filename] is None]
+
+    def result(filename: str, load: Callable[[], models_file.ArtistFile]):
+        if cached[filename] is None:
+            cached[filename] = load()
+            metrics.count("yaml_files_parsed")
+            cache.put(filename, cached[filename])
+        return cached[filename]
+
+    if jobs == 1 or len(missing) < 2:
+        for filename in filenames:
+            load = partial(load_artist_file, filename)
+            yield filename, partial(result, filename, load)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=metrics.start_worker,
+        initargs=("import:parse",),
+    ) as executor:
+        futures = {f: executor.submit(load_artist_file, f) for f in missing}
+        for filename in filenames:
+            load = futures[filename].result if filename in futures else None
+            yield filename, partial(result, filename, load)
+
+
 def get_artist_files(path: str) -> List[str]:
     files = glob.glob(os.path.join(path, "**", ".art*.yaml"), recursive=True)
     if len(files) == 0:
@@ -311,43 +600,114 @@ def get_artist_files(path: str) -> List[str]:
 def load_metadata_file(filename: str) -> models_file.MetadataFile:
     """Load a metadata file."""
     with open(filename, "r", encoding="utf-8") as f:
-        obj = yaml.load(f.read(), Loader=yaml.SafeLoader)
+        obj = yaml.load(f.read(), Loader=SafeLoader)
         obj = cattr.structure(obj, models_file.MetadataFile)
         return obj
 
 
-def process_art_database(art_path: str):
-    """Process some art data."""
+def process_art_database(
+    art_path: str,
+    incremental: bool = False,
+    batch: bool = False,
+    jobs: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+) -> scoped_session:
+    """Process some art data.
+
+    In incremental mode the database is kept between runs and only artist
+    files whose contents changed are re-imported. In batch mode artist files
+    are bulk inserted and the whole import is committed as one transaction.
+    Artist files are parsed by up to jobs worker processes, and structured
+    files are cached in cache_dir between runs.
+    """
 
     # Open the database
-    db = open_database()
+    db = open_database(rebuild=not incremental)
 
     # General metadata, start here
     metapath = os.path.join(art_path, ".metadata.yaml")
     if not os.path.exists(metapath):
         raise FileNotFoundError("No metadata file found.")
 
+    cache = ParseCache(cache_dir)
     try:
-        metadata = load_metadata_file(metapath)
+        metadata = cache.get(metapath)
+        if metadata is None:
+            metadata = load_metadata_file(metapath)
+            metrics.count("yaml_files_parsed")
+            cache.put(metapath, metadata)
     except Exception as e:
         raise ConfigFileError("Error processing file: {}".format(metapath)) from e
 
-    insert_species_dict(db, metadata.species_softname)
-    insert_characters_dict(db, metadata.characters)
-    insert_tags_dicts(
-        db,
-        aliases=metadata.tag_aliases,
-        descriptions=metadata.tag_descriptions,
-        softnames=metadata.tag_softname,
-    )
+    known_files = {record.path: record for record in models_db.SourceFile.query.all()}
+
+    # Characters and tag aliases feed into every artist file, so any change
+    # to the metadata means starting over
+    if incremental and source_file_changed(known_files.get(metapath), metapath):
+        reset_database(db)
+        known_files = {}
+
+    if known_files.pop(metapath, None) is None:
+        insert_species_dict(db, metadata.species_softname)
+        insert_characters_dict(db, metadata.characters)
+        insert_tags_dicts(
+            db,
+            aliases=metadata.tag_aliases,
+            descriptions=metadata.tag_descriptions,
+            softnames=metadata.tag_softname,
+        )
+        record_source_file(db, metapath)
+        db.commit()
 
     # Artist directory files
-    for artist_file in get_artist_files(art_path):
+    artist_files = get_artist_files(art_path)
+    changed_files: Dict[str, Optional[models_db.SourceFile]] = {}
+    for artist_file in artist_files:
+        record = known_files.pop(artist_file, None)
+        if record and not source_file_changed(record, artist_file):
+            continue
+        changed_files[artist_file] = record
+
+    # Remove anything imported from files that no longer exist first, a moved
+    # artist file is imported again under the same artist name
+    for path, record in known_files.items():
+        if record.artist_name:
+            delete_artist(db, record.artist_name)
+        db.delete(record)
+    db.commit()
+
+    bulk = BulkImporter(db) if batch else None
+
+    for artist_file, load in load_artist_files(
+        list(changed_files), jobs=jobs, cache=cache
+    ):
+        record = changed_files[artist_file]
         try:
+            if record and record.artist_name:
+                delete_artist(db, record.artist_name)
+
             artist_file_path = os.path.dirname(artist_file)
-            artist_data = load_artist_file(artist_file)
-            insert_artist_file(db, artist_data, artist_file_path, metadata.tag_aliases)
+            artist_data = load()
+            if bulk:
+                bulk.insert_artist_file(
+                    artist_data, artist_file_path, metadata.tag_aliases
+                )
+            else:
+                insert_artist_file(
+                    db, artist_data, artist_file_path, metadata.tag_aliases
+                )
+            record_source_file(db, artist_file, artist_data.artist.name)
+            if not bulk:
+                db.commit()
         except Exception as e:
+            # The file is imported in one transaction, so this also brings
+            # back the artist's old rows for the next build
+            db.rollback()
             raise ConfigFileError(
                 "Error processing file: {}".format(artist_file)
             ) from e
+
+    db.commit()
+    cache.save([metapath] + artist_files)
+
+    return db
@@ -0,0 +1,101 @@
+import os
+import json
+from typing import Dict, Iterable, Optional, Tuple
+import utils
+
+
+BUILD_FILE_PREFIX = ".artsy-"
+MANIFEST_NAME = BUILD_FILE_PREFIX + "manifest"
+MANIFEST_VERSION = 1
+
+
+class BuildManifest(object):
+    """Size, mtime and content hash of every file a build produced.
+
+    Kept in the output directory so later builds only need to hash files
+    whose stat data changed since they were written.
+    """
+
+    def __init__(self, output_dir: str, algorithm: Optional[str] = None):
+        self.output_dir = output_dir
+        self.algorithm = algorithm
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+
+        # Relative path: (size, mtime_ns, hash)
+        self.entries: Dict[str, Tuple[int, int, str]] = {}
+
+        # Hashes of content written during this build
+        self.recorded: Dict[str, str] = {}
+
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        # Hashes from another algorithm can't be compared with new ones,
+        # unless the manifest is only being read
+        if data.get("version") == MANIFEST_VERSION and self.algorithm in (
+            None,
+            data.get("algorithm"),
+        ):
+            self.entries = {k: tuple(v) for k, v in data["files"].items()}
+
+    def get_hash(self, relpath: str, stat: os.stat_result) -> Optional[str]:
+        """Look up the hash of a file, if it hasn't changed since it was recorded."""
+        entry = self.entries.get(relpath)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def get_hashes(self) -> Dict[str, str]:
+        """Hash every file in the output directory, like utils.get_dir_hashes.
+
+        Files whose size and mtime match the manifest aren't read again.
+        """
+        hashes = {}
+
+        for root, dirs, files in os.walk(self.output_dir):
+            for name in files:
+                fullpath = os.path.join(root, name)
+                relpath = utils.remove_parent_path(self.output_dir, fullpath)
+                if relpath.startswith(BUILD_FILE_PREFIX):
+                    # The manifest and other build state aren't output
+                    continue
+
+                stat = os.stat(fullpath)
+                filehash = self.get_hash(relpath, stat)
+                if filehash is None:
+                    filehash = utils.get_hash(fullpath)
+                    self.entries[relpath] = (stat.st_size, stat.st_mtime_ns, filehash)
+                hashes[relpath] = filehash
+
+        return hashes
+
+    def record(self, relpath: str, filehash: str) -> None:
+        """Note the hash of content this build wrote (or left as is) at a path."""
+        self.recorded[relpath] = filehash
+
+    def save(self, touched_files: Iterable[str]) -> None:
+        files = {}
+        for relpath in set(touched_files):
+            fullpath = os.path.join(self.output_dir, relpath)
+            if not os.path.exists(fullpath):
+                continue
+
+            stat = os.stat(fullpath)
+            filehash = self.recorded.get(relpath) or self.get_hash(relpath, stat)
+            if filehash is None:
+                filehash = utils.get_hash(fullpath)
+            files[relpath] = (stat.st_size, stat.st_mtime_ns, filehash)
+
+        self.entries = files
+        data = {
+            "version": MANIFEST_VERSION,
+            "algorithm": self.algorithm,
+            "files": files,
+        }
+        utils.write_atomic(self.path, json.dumps(data).encode("utf-8"))
@@ -0,0 +1,137 @@
+"""Markdown conversion, cached in memory and on disk."""
+
+import os
+from collections import OrderedDict
+from typing import Optional
+import markdown
+from markdown import Markdown
+import hashing
+import mdextensions
+import utils
+from mdextensions import InternalLinksExtension
+
+
+EXTENSIONS = ["markdown.extensions.nl2br", InternalLinksExtension]
+
+
+def get_config_version() -> str:
+    """Describe everything besides the text that decides the output."""
+    with open(mdextensions.__file__, "rb") as f:
+        source = f.read()
+    return "{}|{}|{}".format(
+        markdown.__version__,
+        ",".join(getattr(e, "__name__", e) for e in EXTENSIONS),
+        hashing.get_data_hash(source, "blake2b"),
+    )
+
+
+class MarkdownRenderer(object):
+    """Convert Markdown, remembering the results.
+
+    The most recently used results are kept in memory, up to max_entries.
+    With a cache_dir every result is also stored on disk, where other worker
+    processes and later builds find it. Files on disk are touched when used,
+    and prune() removes the least recently used beyond max_disk_entries.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_entries: int = 4096,
+        max_disk_entries: int = 65536,
+    ):
+        self.md = Markdown(
+            extensions=[e if isinstance(e, str) else e() for e in EXTENSIONS]
+        )
+        self.config = get_config_version()
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory: "OrderedDict[str, str]" = OrderedDict()
+        self.path = os.path.join(cache_dir, "markdown") if cache_dir else None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _get_file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + ".html")
+
+    def _load(self, key: str) -> Optional[str]:
+        if not self.path:
+            return None
+        filename = self._get_file(key)
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                html = f.read()
+            # Mark it as recently used
+            os.utime(filename)
+        except OSError:
+            return None
+        return html
+
+    def _store(self, key: str, html: str) -> None:
+        if not self.path:
+            return
+
+        # Workers may store the same entry at once, so never write in place
+        filename = self._get_file(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with utils.open_atomic(filename, "w", encoding="utf-8") as f:
+            f.write(html)
+
+    def prune(self) -> int:
+        """Remove the least recently used files beyond max_disk_entries.
+
+        Returns the number of files removed.
+        """
+        if not self.path or not os.path.isdir(self.path):
+            return 0
+
+        filenames = []
+        for subdir in os.scandir(self.path):
+            if subdir.is_dir():
+                filenames.extend(entry.path for entry in os.scandir(subdir.path))
+        excess = len(filenames) - self.max_disk_entries
+        if excess <= 0:
+            return 0
+
+        def last_used(filename: str) -> int:
+            try:
+                return os.stat(filename).st_mtime_ns
+            except OSError:
+                return 0
+
+        removed = 0
+        for filename in sorted(filenames, key=last_used)[:excess]:
+            try:
+                os.unlink(filename)
+                removed += 1
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+        return removed
+
+    def convert(self, text: str) -> str:
+        data = "{}\0{}".format(self.config, text).encode("utf-8")
+        key = hashing.get_data_hash(data, "blake2b")
+
+        html = self.memory.get(key)
+        if html is not None:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return html
+
+        html = self._load(key)
+        if html is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            html = self.md.convert(text)
+            # Extensions can keep state between documents
+            self.md.reset()
+            self._store(key, html)
+
+        self.memory[key] = html
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        return html
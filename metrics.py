@@ -0,0 +1,210 @@
+"""Phase timings, counters and histograms describing a build."""
+
+import os
+import json
+import time
+import multiprocessing.util
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+from profiler import PhaseProfiler
+import utils
+
+REPORT_VERSION = 1
+PERCENTILES = (50, 90, 99)
+
+
+def get_cpu_time() -> float:
+    """CPU time of this process and of the children it has waited for."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def summarize(values: List[float]) -> dict:
+    ordered = sorted(values)
+    summary = {
+        "count": len(ordered),
+        "total": sum(ordered),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "mean": sum(ordered) / len(ordered),
+    }
+    for percentile in PERCENTILES:
+        index = min(len(ordered) - 1, len(ordered) * percentile // 100)
+        summary["p{}".format(percentile)] = ordered[index]
+    return summary
+
+
+class Metrics(object):
+    """Everything measured during one build.
+
+    Phases are timed spans, kept individually so they can be written as a
+    trace. Forked workers measure into their inherited copy and hand it back
+    with collect(), for the parent to merge(). With a profiler, phases that
+    aren't part of another phase in the same process are profiled.
+    """
+
+    def __init__(self, profiler: Optional[PhaseProfiler] = None):
+        self.origin = time.perf_counter()
+        self.profiler = profiler
+        self.depth = 0
+        self.phases: List[dict] = []
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, List[float]] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        profiling = self.profiler is not None and self.depth == 0
+        self.depth += 1
+        if profiling:
+            self.profiler.start()
+
+        start = time.perf_counter()
+        cpu = get_cpu_time()
+        try:
+            yield
+        finally:
+            record = {
+                "name": name,
+                "pid": os.getpid(),
+                "start": start - self.origin,
+                "wall": time.perf_counter() - start,
+                "cpu": get_cpu_time() - cpu,
+            }
+            self.phases.append(record)
+
+            # Writing the profile isn't part of the phase
+            self.depth -= 1
+            if profiling:
+                self.profiler.stop(name)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float) -> None:
+        self.histograms.setdefault(name, []).append(value)
+
+    def collect(self) -> dict:
+        """Hand over everything measured so far and start again."""
+        data = {
+            "phases": self.phases,
+            "counters": self.counters,
+            "histograms": self.histograms,
+        }
+        self.phases = []
+        self.counters = {}
+        self.histograms = {}
+        return data
+
+    def merge(self, data: dict) -> None:
+        self.phases.extend(data["phases"])
+        for name, amount in data["counters"].items():
+            self.count(name, amount)
+        for name, values in data["histograms"].items():
+            self.histograms.setdefault(name, []).extend(values)
+
+    def report(self) -> dict:
+        # Phases with the same name, as run by workers, add up
+        phases: Dict[str, dict] = {}
+        for phase in self.phases:
+            total = phases.setdefault(
+                phase["name"], {"count": 0, "wall": 0.0, "cpu": 0.0}
+            )
+            total["count"] += 1
+            total["wall"] += phase["wall"]
+            total["cpu"] += phase["cpu"]
+
+        return {
+            "version": REPORT_VERSION,
+            "wall": time.perf_counter() - self.origin,
+            "phases": phases,
+            "counters": dict(sorted(self.counters.items())),
+            "histograms": {
+                name: summarize(values)
+                for name, values in sorted(self.histograms.items())
+            },
+        }
+
+    def trace(self) -> dict:
+        """Phases as Chrome trace events, one row per process."""
+        events = [
+            {
+                "name": phase["name"],
+                "ph": "X",
+                "ts": phase["start"] * 1e6,
+                "dur": phase["wall"] * 1e6,
+                "pid": phase["pid"],
+                "tid": phase["pid"],
+                "args": {"cpu": phase["cpu"]},
+            }
+            for phase in self.phases
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_json(path: str, data: dict) -> None:
+    with utils.open_atomic(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+
+_metrics = Metrics()
+
+
+def reset(
+    profile_dir: Optional[str] = None, memory_dir: Optional[str] = None
+) -> None:
+    """Start measuring a new build, profiling its phases if asked to."""
+    global _metrics
+    profiler = None
+    if profile_dir or memory_dir:
+        profiler = PhaseProfiler(profile_dir, memory_dir)
+    _metrics = Metrics(profiler)
+
+
+def phase(name: str):
+    return _metrics.phase(name)
+
+
+def count(name: str, amount: int = 1) -> None:
+    _metrics.count(name, amount)
+
+
+def observe(name: str, value: float) -> None:
+    _metrics.observe(name, value)
+
+
+def collect() -> dict:
+    return _metrics.collect()
+
+
+def start_worker(phase_name: Optional[str] = None) -> None:
+    """Forget what a forked worker inherited, the parent already has it.
+
+    Workers doing many small tasks are better profiled as a whole: with a
+    phase_name the worker's profile covers everything until it exits.
+    """
+    _metrics.collect()
+    _metrics.depth = 0
+
+    profiler = _metrics.profiler
+    if profiler:
+        profiler.forget()
+        if phase_name:
+            profiler.start()
+            multiprocessing.util.Finalize(
+                None, profiler.stop, args=(phase_name,), exitpriority=0
+            )
+
+
+def merge(data: Optional[dict]) -> None:
+    if data:
+        _metrics.merge(data)
+
+
+def save(report_file: Optional[str] = None, trace_file: Optional[str] = None):
+    """Write the report, the trace and the profiles, where asked for."""
+    if _metrics.profiler:
+        _metrics.profiler.save()
+    if report_file:
+        write_json(report_file, _metrics.report())
+    if trace_file:
+        write_json(trace_file, _metrics.trace())
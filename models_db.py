@@ -1,7 +1,8 @@
 from utils import LimitFilter, build_filename, clean_string
 from typing import List, Optional, Iterable
 from sqlalchemy import Table, Column, Integer, String, ForeignKey, Boolean, Date, desc
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import inspect, true
+from sqlalchemy.orm import relationship, backref, object_session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import TypeDecorator
 import json
@@ -79,6 +80,22 @@ submission_form_association_table = Table(
 )
 
 
+# Import bookkeeping
+
+
+class SourceFile(Base):
+    __tablename__ = "source_files"
+
+    path = Column(String, primary_key=True)
+    mtime = Column(Integer)
+    size = Column(Integer)
+    hash = Column(String)
+    artist_name = Column(String, nullable=True)
+
+    def __repr__(self):
+        return u"SourceFile(path={0})".format(self.path)
+
+
 # Mixins
 
 
@@ -89,7 +106,16 @@ class SubmissionFilterMixin(object):
         if not filter:
             return self.submissions
 
-        return filter.filter(self.submissions)
+        # Already loaded (see db_helper.preload_render_data), filter in memory
+        if "submissions" not in inspect(self).unloaded:
+            return filter.filter(self.submissions)
+
+        return (
+            object_session(self)
+            .query(Submission)
+            .with_parent(self, type(self).submissions)
+            .filter(Submission.limit_clause(filter))
+        )
 
 
 # Tables
@@ -109,8 +135,10 @@ class Artist(Base, SubmissionFilterMixin):
     def slug(self) -> str:
         return clean_string(self.name).lower()
 
-    def get_path(self, limit: Optional[LimitFilter] = None) -> str:
-        return "{}/{}".format(self.slug(), build_filename("index", limit=limit))
+    def get_path(self, limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return "{}/{}".format(
+            self.slug(), build_filename("index", limit=limit, page=page)
+        )
 
     def __repr__(self):
         return u"Artist(name={0})".format(self.name)
@@ -118,18 +146,15 @@ class Artist(Base, SubmissionFilterMixin):
     # Static methods
     @staticmethod
     def get_all(limit: Optional[LimitFilter] = None) -> Iterable["__class__"]:
-        artist_results = Artist.query.order_by(Artist.name).all()
-        if len(artist_results) < 1:
-            return []
-
-        # TODO: Figure out how to turn limits into query filters
-        for artist in artist_results:
-            if any(map(lambda m: m.is_visible(limit), artist.submissions)):
-                yield artist
+        return (
+            Artist.query.filter(Artist.submissions.any(Submission.limit_clause(limit)))
+            .order_by(Artist.name)
+            .all()
+        )
 
     @staticmethod
-    def get_path_all(limit: Optional[LimitFilter] = None) -> str:
-        return build_filename("all_artists", limit=limit)
+    def get_path_all(limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return build_filename("all_artists", limit=limit, page=page)
 
 
 class Submission(Base):
@@ -176,6 +201,14 @@ class Submission(Base):
     def is_visible(self, limit: Optional[LimitFilter] = None) -> bool:
         return limit.is_visible(self) if limit else True
 
+    @staticmethod
+    def limit_clause(limit: Optional[LimitFilter] = None):
+        """SQL counterpart to is_visible."""
+        if not limit:
+            return true()
+
+        return limit.get_clause(Submission.visibility, Submission.lockout)
+
     def get_path(
         self, in_artist_dir: bool = False, limit: Optional[LimitFilter] = None
     ) -> str:
@@ -193,14 +226,11 @@ class Submission(Base):
 
     # Static methods
     def get_all(limit: Optional[LimitFilter] = None) -> Iterable["__class__"]:
-        submission_results = Submission.query.order_by(desc(Submission.date)).all()
-        if len(submission_results) < 1:
-            return []
-
-        # TODO: Figure out how to turn limits into query filters
-        for sub in submission_results:
-            if sub.is_visible(limit):
-                yield sub
+        return (
+            Submission.query.filter(Submission.limit_clause(limit))
+            .order_by(desc(Submission.date))
+            .all()
+        )
 
 
 class Species(Base, SubmissionFilterMixin):
@@ -234,26 +264,27 @@ class Species(Base, SubmissionFilterMixin):
         else:
             return self.species_name
 
-    def get_path(self, limit: Optional[LimitFilter] = None) -> str:
-        return "_species/{}".format(build_filename(self.slug(), limit=limit))
+    def get_path(self, limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return "_species/{}".format(
+            build_filename(self.slug(), limit=limit, page=page)
+        )
 
     def __repr__(self):
         return u"Species(species_name={0})".format(self.species_name)
 
     # Static methods
     def get_all(limit: Optional[LimitFilter] = None) -> Iterable["__class__"]:
-        species_results = Species.query.order_by(Species.species_name).all()
-        if len(species_results) < 1:
-            return []
-
-        # TODO: Figure out how to turn limits into query filters
-        for spec in species_results:
-            if any(map(lambda m: m.is_visible(limit), spec.submissions)):
-                yield spec
+        return (
+            Species.query.filter(
+                Species.submissions.any(Submission.limit_clause(limit))
+            )
+            .order_by(Species.species_name)
+            .all()
+        )
 
     @staticmethod
-    def get_path_all(limit: Optional[LimitFilter] = None) -> str:
-        return build_filename("all_species", limit=limit)
+    def get_path_all(limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return build_filename("all_species", limit=limit, page=page)
 
 
 class Tag(Base, SubmissionFilterMixin):
@@ -288,8 +319,8 @@ class Tag(Base, SubmissionFilterMixin):
         else:
             return self.friendly_name()
 
-    def get_path(self, limit: Optional[LimitFilter] = None) -> str:
-        return "_tags/{}".format(build_filename(self.slug(), limit=limit))
+    def get_path(self, limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return "_tags/{}".format(build_filename(self.slug(), limit=limit, page=page))
 
     def __repr__(self):
         return u"Tag(tag_id={0})".format(self.tag_id)
@@ -298,22 +329,15 @@ class Tag(Base, SubmissionFilterMixin):
     def get_all(
         limit: Optional[LimitFilter] = None, ignore: Optional[List[str]] = None
     ) -> Iterable["__class__"]:
-        query = Tag.query.order_by(Tag.tag_id)
+        query = Tag.query.filter(Tag.submissions.any(Submission.limit_clause(limit)))
         if ignore:
-            query = query.filter(Tag.tag_name not in ignore)
-
-        tag_results = query.all()
-        if len(tag_results) < 1:
-            return []
+            query = query.filter(Tag.tag_name.notin_(ignore))
 
-        # TODO: Figure out how to turn limits into query filters
-        for tag in tag_results:
-            if any(map(lambda m: m.is_visible(limit), tag.submissions)):
-                yield tag
+        return query.order_by(Tag.tag_id).all()
 
     @staticmethod
-    def get_path_all(limit: Optional[LimitFilter] = None) -> str:
-        return build_filename("all_tags", limit=limit)
+    def get_path_all(limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return build_filename("all_tags", limit=limit, page=page)
 
 
 class Group(Base, SubmissionFilterMixin):
@@ -346,26 +370,25 @@ class Group(Base, SubmissionFilterMixin):
         else:
             return self.friendly_name()
 
-    def get_path(self, limit: Optional[LimitFilter] = None) -> str:
-        return "_groups/{}".format(build_filename(self.slug(), limit=limit))
+    def get_path(self, limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return "_groups/{}".format(
+            build_filename(self.slug(), limit=limit, page=page)
+        )
 
     def __repr__(self):
         return u"Group(group_name={0})".format(self.group_name)
 
     # Static methods
     def get_all(limit: Optional[LimitFilter] = None) -> Iterable["__class__"]:
-        group_results = Group.query.order_by(Group.group_name).all()
-        if len(group_results) < 1:
-            return []
-
-        # TODO: Figure out how to turn limits into query filters
-        for group in group_results:
-            if any(map(lambda m: m.is_visible(limit), group.submissions)):
-                yield group
+        return (
+            Group.query.filter(Group.submissions.any(Submission.limit_clause(limit)))
+            .order_by(Group.group_name)
+            .all()
+        )
 
     @staticmethod
-    def get_path_all(limit: Optional[LimitFilter] = None) -> str:
-        return build_filename("all_groups", limit=limit)
+    def get_path_all(limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return build_filename("all_groups", limit=limit, page=page)
 
 
 class Character(Base):
@@ -405,20 +428,16 @@ class Character(Base):
 
     # Static methods
     def get_all(limit: Optional[LimitFilter] = None) -> Iterable["__class__"]:
-        character_results: List[Character] = Character.query.order_by(
-            Character.name
-        ).all()
-        if len(character_results) < 1:
-            return []
-
-        # TODO: Figure out how to turn limits into query filters
-        for char in character_results:
-            if any(char.submissions_filtered(limit)):
-                yield char
+        visible_forms = CharacterForm.submissions.any(Submission.limit_clause(limit))
+        return (
+            Character.query.filter(Character.forms.any(visible_forms))
+            .order_by(Character.name)
+            .all()
+        )
 
     @staticmethod
-    def get_path_all(limit: Optional[LimitFilter] = None) -> str:
-        return build_filename("all_characters", limit=limit)
+    def get_path_all(limit: Optional[LimitFilter] = None, page: int = 1) -> str:
+        return build_filename("all_characters", limit=limit, page=page)
 
 
 class CharacterForm(Base, SubmissionFilterMixin):
@@ -471,11 +490,10 @@ class CharacterForm(Base, SubmissionFilterMixin):
 
     # Static methods
     def get_all(limit: Optional[LimitFilter] = None) -> Iterable["__class__"]:
-        character_results = CharacterForm.query.order_by(CharacterForm.form_id).all()
-        if len(character_results) < 1:
-            return []
-
-        # TODO: Figure out how to turn limits into query filters
-        for char in character_results:
-            if any(map(lambda m: m.is_visible(limit), char.submissions)):
-                yield char
+        return (
+            CharacterForm.query.filter(
+                CharacterForm.submissions.any(Submission.limit_clause(limit))
+            )
+            .order_by(CharacterForm.form_id)
+            .all()
+        )
@@ -0,0 +1,80 @@
+"""On-disk cache of structured metadata and artist files."""
+
+import os
+import pickle
+from typing import Any, Dict, Iterable, Optional, Tuple
+import hashing
+import models_file
+import utils
+
+
+CACHE_NAME = "parsed.pickle"
+
+
+def get_schema_version() -> str:
+    """Version of the models_file classes, changing whenever the module does."""
+    with open(models_file.__file__, "rb") as f:
+        source = f.read()
+    return "{}-{}".format(
+        pickle.HIGHEST_PROTOCOL, hashing.get_data_hash(source, "blake2b")
+    )
+
+
+class ParseCache(object):
+    """Structured files keyed by path, valid while the content hash matches."""
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.path = os.path.join(cache_dir, CACHE_NAME) if cache_dir else None
+        self.schema = get_schema_version()
+
+        # Path: (content hash, structured object)
+        self.entries: Dict[str, Tuple[str, Any]] = {}
+        self.hashes: Dict[str, str] = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+
+        if self.path:
+            self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            # Missing, truncated or written by incompatible code
+            return
+
+        if data.get("schema") == self.schema:
+            self.entries = data["files"]
+
+    def save(self, paths: Iterable[str]) -> None:
+        """Write the cache, evicting entries for anything not in paths."""
+        paths = set(paths)
+        if not paths.issuperset(self.entries):
+            self.entries = {k: v for k, v in self.entries.items() if k in paths}
+            self.changed = True
+
+        if not self.path or not self.changed:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with utils.open_atomic(self.path) as f:
+            data = {"schema": self.schema, "files": self.entries}
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.changed = False
+
+    def get(self, path: str) -> Optional[Any]:
+        """Look up a file, hashing it now so a later put matches this content."""
+        filehash = self.hashes[path] = hashing.get_file_hash(path)
+        entry = self.entries.get(path)
+        if entry and entry[0] == filehash:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        return None
+
+    def put(self, path: str, obj: Any) -> None:
+        self.entries[path] = (self.hashes[path], obj)
+        self.changed = True
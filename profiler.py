@@ -0,0 +1,145 @@
+"""cProfile and tracemalloc, scoped to the phases of a build."""
+
+import os
+import glob
+import json
+import pstats
+import cProfile
+import tracemalloc
+from typing import Dict, List, Optional
+
+# Sites listed for each phase's allocations, and functions for its profile
+TOP_SITES = 20
+TOP_FUNCTIONS = 50
+
+# Sites of the profilers' own allocations
+PROFILER_FILES = (cProfile.__file__, tracemalloc.__file__)
+
+# Part files of a phase are named NAME@PID-N, and combined when saving
+PART_SEPARATOR = "@"
+
+
+def get_filename(directory: str, name: str, extension: str) -> str:
+    return os.path.join(directory, "{}.{}".format(name.replace(":", "-"), extension))
+
+
+class PhaseProfiler(object):
+    """Profile the phases of a build, in whichever process runs them.
+
+    Every process writes a part file per phase to the output directories and
+    save() combines the parts of each phase. With profile_dir phases are run
+    under cProfile, giving NAME.pstats and the same sorted by cumulative time
+    in NAME.txt. With memory_dir allocations are traced from the start of
+    each phase, and NAME.memory.json lists its peak and the sites holding the
+    most memory allocated during it when it ends.
+    """
+
+    def __init__(
+        self, profile_dir: Optional[str] = None, memory_dir: Optional[str] = None
+    ):
+        self.profile_dir = profile_dir
+        self.memory_dir = memory_dir
+
+        self.profile: Optional[cProfile.Profile] = None
+        self.parts = 0
+
+        for directory in (profile_dir, memory_dir):
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                # Left behind by a build that didn't finish
+                for part in self._get_parts(directory, "*"):
+                    os.unlink(part)
+
+        if memory_dir and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _get_parts(self, directory: str, pattern: str) -> List[str]:
+        return glob.glob(os.path.join(directory, "*" + PART_SEPARATOR + pattern))
+
+    def _get_part(self, directory: str, name: str, extension: str) -> str:
+        part = "{}{}{}-{}".format(name, PART_SEPARATOR, os.getpid(), self.parts)
+        return get_filename(directory, part, extension)
+
+    def start(self) -> None:
+        if self.memory_dir:
+            # Comparing snapshots of a large heap takes seconds, so only
+            # allocations made from here on are traced
+            tracemalloc.clear_traces()
+            tracemalloc.reset_peak()
+        if self.profile_dir:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self, name: str) -> None:
+        self.parts += 1
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self._get_part(self.profile_dir, name, "pstats"))
+            self.profile = None
+
+        if self.memory_dir:
+            size, peak = tracemalloc.get_traced_memory()
+            stats = [
+                stat
+                for stat in tracemalloc.take_snapshot().statistics("lineno")
+                if stat.traceback[0].filename not in PROFILER_FILES
+            ]
+            data = {
+                "pid": os.getpid(),
+                "size": size,
+                "peak": peak,
+                "sites": [
+                    {
+                        "site": "{}:{}".format(
+                            stat.traceback[0].filename, stat.traceback[0].lineno
+                        ),
+                        "size": stat.size,
+                        "count": stat.count,
+                    }
+                    for stat in stats[:TOP_SITES]
+                ],
+            }
+            part = self._get_part(self.memory_dir, name, "memory.json")
+            with open(part, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+
+    def forget(self) -> None:
+        """Stop a phase a forked worker inherited while it was running."""
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile = None
+
+    def save(self) -> None:
+        """Combine the part files of every phase, from every process."""
+        if self.profile_dir:
+            for name, parts in self._group_parts(self.profile_dir, "pstats").items():
+                profile_file = get_filename(self.profile_dir, name, "pstats")
+                pstats.Stats(*parts).dump_stats(profile_file)
+                for part in parts:
+                    os.unlink(part)
+
+                stats_file = get_filename(self.profile_dir, name, "txt")
+                with open(stats_file, "w", encoding="utf-8") as f:
+                    stats = pstats.Stats(profile_file, stream=f)
+                    stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+
+        if self.memory_dir:
+            groups = self._group_parts(self.memory_dir, "memory.json")
+            for name, parts in groups.items():
+                processes = []
+                for part in parts:
+                    with open(part, "r", encoding="utf-8") as f:
+                        processes.append(json.load(f))
+                    os.unlink(part)
+
+                memory_file = get_filename(self.memory_dir, name, "memory.json")
+                with open(memory_file, "w", encoding="utf-8") as f:
+                    json.dump(processes, f, indent=2)
+
+    def _group_parts(self, directory: str, extension: str) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for part in sorted(self._get_parts(directory, "*." + extension)):
+            name = os.path.basename(part).rsplit(PART_SEPARATOR, 1)[0]
+            groups.setdefault(name, []).append(part)
+        return groups
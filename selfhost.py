@@ -2,8 +2,8 @@
 '''Self hosted Artsy.'''
 
 import os
-from http.server import HTTPServer, SimpleHTTPRequestHandler
 from artsy import generate_static_site
+from server import serve
 import utils
 
 # Configure
@@ -12,12 +12,25 @@ args = utils.parse_args()
 # Generate
 print("Generating content...")
 limit = utils.get_limit_from_args(args)
-generate_static_site(args.indir, args.outdir, base_limit=limit, force=args.force)
+generate_static_site(
+    args.indir,
+    args.outdir,
+    base_limit=limit,
+    force=args.force,
+    jobs=args.jobs,
+    incremental=args.incremental,
+    batch=args.batch,
+    hash_algorithm=args.hashAlgorithm,
+    cache_dir=args.cacheDir,
+    page_size=args.pageSize,
+    template_reload=not args.noTemplateReload,
+    template_modules=args.templateModules,
+    metrics_file=args.metrics,
+    trace_file=args.trace,
+    profile_dir=args.profile,
+    memory_profile_dir=args.profileMemory,
+)
 
 # Host
-print("Hosting content on http://localhost:8000/")
-os.chdir(os.path.join(os.path.dirname(__file__), args.outdir))
-
-server_address = ('', 8000)
-httpd = HTTPServer(server_address, SimpleHTTPRequestHandler)
-httpd.serve_forever()
+print("Hosting content on http://{}:{}/".format(args.bind or "localhost", args.port))
+serve(os.path.join(os.path.dirname(__file__), args.outdir), args.bind, args.port)
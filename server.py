@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""Serve a built gallery over HTTP/1.1 to many clients at once."""
+
+import io
+import os
+import re
+import argparse
+import datetime
+import email.utils
+import threading
+import urllib.parse
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import BinaryIO, Optional, Tuple
+from manifest import BUILD_FILE_PREFIX, MANIFEST_NAME, BuildManifest
+
+
+# Image names don't change with their content, so they still get revalidated
+# after a while. Pages are revalidated every time, which is cheap with ETags.
+IMAGE_CACHE_CONTROL = "public, max-age=604800"
+PAGE_CACHE_CONTROL = "no-cache"
+
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ManifestHashes(object):
+    """Content hashes from the build manifest, reloaded when it's rewritten."""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.mtime: Optional[int] = None
+        self.manifest: Optional[BuildManifest] = None
+
+    def get(self, relpath: str, stat: os.stat_result) -> Optional[str]:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+        with self.lock:
+            if mtime != self.mtime:
+                self.manifest = BuildManifest(self.output_dir)
+                self.mtime = mtime
+            manifest = self.manifest
+        return manifest.get_hash(relpath, stat)
+
+
+class GalleryRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files with keep-alive, validators, caching headers and ranges.
+
+    ETags come from the build manifest where it knows the file, and from the
+    file's stat data otherwise. File contents are sent with sendfile.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # Idle keep-alive connections each hold a thread, so don't wait forever
+    timeout = 60
+
+    def __init__(self, *args, hashes: Optional[ManifestHashes] = None, **kwargs):
+        # Requests are handled from the base constructor, so set this first
+        self.hashes = hashes
+        self.byte_range: Tuple[int, int] = (0, 0)
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        f = self.send_head()
+        if f:
+            try:
+                if isinstance(f, io.BytesIO):
+                    # Directory listings are generated in memory
+                    self.copyfile(f, self.wfile)
+                else:
+                    offset, count = self.byte_range
+                    if count:
+                        self.connection.sendfile(f, offset, count)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+            finally:
+                f.close()
+
+    def do_HEAD(self) -> None:
+        f = self.send_head()
+        if f:
+            f.close()
+
+    def send_head(self) -> Optional[BinaryIO]:
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            parts = urllib.parse.urlsplit(self.path)
+            index = os.path.join(path, "index.html")
+            if not parts.path.endswith("/") or not os.path.isfile(index):
+                # Redirects and directory listings work as usual
+                return super().send_head()
+            path = index
+
+        relpath = os.path.relpath(path, self.directory)
+        if relpath.startswith(BUILD_FILE_PREFIX) or path.endswith("/"):
+            # Build state isn't part of the gallery
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        try:
+            return self.send_file_head(f, path, relpath)
+        except BaseException:
+            f.close()
+            raise
+
+    def send_file_head(
+        self, f: BinaryIO, path: str, relpath: str
+    ) -> Optional[BinaryIO]:
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        etag = self.get_etag(relpath, stat)
+        ctype = self.guess_type(path)
+
+        def send_validators() -> None:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+            if ctype.startswith("image/"):
+                self.send_header("Cache-Control", IMAGE_CACHE_CONTROL)
+            else:
+                self.send_header("Cache-Control", PAGE_CACHE_CONTROL)
+
+        if not self.is_modified(etag, stat):
+            f.close()
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            send_validators()
+            self.end_headers()
+            return None
+
+        byte_range = self.get_range(etag, stat)
+        if byte_range == (size, 0):
+            f.close()
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        if byte_range:
+            offset, count = byte_range
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header(
+                "Content-Range",
+                "bytes {}-{}/{}".format(offset, offset + count - 1, size),
+            )
+        else:
+            offset, count = 0, size
+            self.send_response(HTTPStatus.OK)
+
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(count))
+        self.send_header("Accept-Ranges", "bytes")
+        send_validators()
+        self.end_headers()
+
+        self.byte_range = (offset, count)
+        return f
+
+    def get_etag(self, relpath: str, stat: os.stat_result) -> str:
+        filehash = self.hashes.get(relpath, stat) if self.hashes else None
+        if filehash:
+            return '"{}-{:x}"'.format(filehash, stat.st_size)
+
+        # Without a hash the content can only be assumed to be the same
+        return 'W/"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+    def is_modified(self, etag: str, stat: os.stat_result) -> bool:
+        """Check the request's conditions, If-None-Match taking precedence."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            if if_none_match.strip() == "*":
+                return False
+
+            # Compared weakly, as GET and HEAD do
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            return strip_weak(etag) not in {strip_weak(tag) for tag in tags}
+
+        modified_since = parse_date(self.headers.get("If-Modified-Since"))
+        if modified_since:
+            return int(stat.st_mtime) > modified_since.timestamp()
+
+        return True
+
+    def get_range(self, etag: str, stat: os.stat_result) -> Optional[Tuple[int, int]]:
+        """Find the (offset, count) of a requested byte range.
+
+        Returns None to send the whole file, and (size, 0) when the range
+        can't be satisfied. Only single ranges are supported, the whole file
+        is sent for anything else.
+        """
+        match = RANGE_REGEX.match(self.headers.get("Range", "").strip())
+        if not match or match.groups() == ("", ""):
+            return None
+
+        if_range = self.headers.get("If-Range")
+        if if_range:
+            if_range = if_range.strip()
+            if if_range.startswith('"'):
+                # Ranges of different content can't be combined
+                if etag.startswith("W/") or if_range != etag:
+                    return None
+            elif if_range != self.date_time_string(stat.st_mtime):
+                return None
+
+        size = stat.st_size
+        first, last = match.groups()
+        if not first:
+            # The last bytes of the file
+            suffix = int(last)
+            if suffix == 0 or size == 0:
+                return size, 0
+            offset = max(0, size - suffix)
+            return offset, size - offset
+
+        offset = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < offset:
+            # Invalid ranges are ignored
+            return None
+        if offset >= size:
+            return size, 0
+        return offset, end - offset + 1
+
+
+def strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, IndexError, OverflowError, ValueError):
+        # Ill-formed dates are ignored
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+
+class GalleryServer(ThreadingHTTPServer):
+    """A thread per connection, with room for bursts of new connections."""
+
+    request_queue_size = 128
+
+
+def serve(output_dir: str, address: str = "", port: int = 8000) -> None:
+    handler = partial(
+        GalleryRequestHandler, directory=output_dir, hashes=ManifestHashes(output_dir)
+    )
+    with GalleryServer((address, port), handler) as httpd:
+        httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a built gallery")
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        help="Output directory",
+        default="output",
+        metavar="OUTPUT_DIR",
+    )
+    parser.add_argument(
+        "--bind", help="Address to listen on", default="", metavar="ADDRESS"
+    )
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8000)
+    args = parser.parse_args()
+
+    host = args.bind or "localhost"
+    print("Hosting content on http://{}:{}/".format(host, args.port))
+    serve(args.outdir, args.bind, args.port)
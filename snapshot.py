@@ -0,0 +1,365 @@
+"""Frozen, in-memory copy of the imported gallery used for rendering."""
+
+from typing import Dict, Iterable, Optional, Tuple
+from utils import LimitFilter, VisibilityIndex
+import models_db
+import db_helper
+
+
+class Record(object):
+    """Immutable row with its relationships resolved into tuples.
+
+    mask holds a bit for every limit in limit_index the record is visible
+    under, so visibility checks for known limits are a single AND.
+    """
+
+    __slots__ = ("mask", "limit_index")
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} records are immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} records are immutable".format(type(self).__name__))
+
+    def _link(self, **kwargs) -> None:
+        # Relationships are cyclic, so they're filled in once every record exists
+        for name, value in kwargs.items():
+            object.__setattr__(self, name, value)
+
+    def is_visible(self, limit: Optional[LimitFilter] = None) -> bool:
+        bit = self.limit_index.get_bit(limit)
+        if bit is not None:
+            return bool(self.mask & bit)
+
+        return any(self.submissions_filtered(limit))
+
+
+class SubmissionFilterMixin(object):
+    __slots__ = ()
+
+    def submissions_filtered(
+        self, filter: Optional[LimitFilter] = None
+    ) -> Iterable["Submission"]:
+        bit = self.limit_index.get_bit(filter)
+        if bit is not None:
+            return (s for s in self.submissions if s.mask & bit)
+
+        if not filter:
+            return self.submissions
+
+        return filter.filter(self.submissions)
+
+
+# Records, sharing their helper methods with models_db
+
+
+class Artist(SubmissionFilterMixin, Record):
+    __slots__ = ("name", "links", "path", "submissions")
+
+    slug = models_db.Artist.slug
+    get_path = models_db.Artist.get_path
+    get_path_all = staticmethod(models_db.Artist.get_path_all)
+    __repr__ = models_db.Artist.__repr__
+
+
+class Submission(Record):
+    __slots__ = (
+        "submission_id",
+        "submission_type",
+        "filename",
+        "title",
+        "slug",
+        "date",
+        "description",
+        "visibility",
+        "lockout",
+        "sequence",
+        "my_links",
+        "artist_links",
+        "artist",
+        "characters",
+        "tags",
+        "species",
+        "groups",
+    )
+
+    get_date_str = models_db.Submission.get_date_str
+    get_file_ext = models_db.Submission.get_file_ext
+    get_thumbnail_name = models_db.Submission.get_thumbnail_name
+    get_path = models_db.Submission.get_path
+    __repr__ = models_db.Submission.__repr__
+
+    def is_visible(self, limit: Optional[LimitFilter] = None) -> bool:
+        bit = self.limit_index.get_bit(limit)
+        if bit is not None:
+            return bool(self.mask & bit)
+
+        return limit.is_visible(self) if limit else True
+
+
+class Species(SubmissionFilterMixin, Record):
+    __slots__ = ("species_name", "description", "softname", "forms", "submissions")
+
+    slug = models_db.Species.slug
+    get_friendly_name = models_db.Species.get_friendly_name
+    get_detail = models_db.Species.get_detail
+    get_path = models_db.Species.get_path
+    get_path_all = staticmethod(models_db.Species.get_path_all)
+    __repr__ = models_db.Species.__repr__
+
+
+class Tag(SubmissionFilterMixin, Record):
+    __slots__ = (
+        "tag_id",
+        "tag_name",
+        "description",
+        "softname",
+        "parent",
+        "children",
+        "submissions",
+    )
+
+    slug = models_db.Tag.slug
+    get_friendly_name = models_db.Tag.get_friendly_name
+    get_detail = models_db.Tag.get_detail
+    get_path = models_db.Tag.get_path
+    get_path_all = staticmethod(models_db.Tag.get_path_all)
+    __repr__ = models_db.Tag.__repr__
+
+
+class Group(SubmissionFilterMixin, Record):
+    __slots__ = ("group_name", "description", "softname", "submissions")
+
+    slug = models_db.Group.slug
+    get_friendly_name = models_db.Group.get_friendly_name
+    get_detail = models_db.Group.get_detail
+    get_path = models_db.Group.get_path
+    get_path_all = staticmethod(models_db.Group.get_path_all)
+    __repr__ = models_db.Group.__repr__
+
+
+class Character(Record):
+    __slots__ = ("name", "description", "owner", "root", "links", "forms")
+
+    slug = models_db.Character.slug
+    get_path = models_db.Character.get_path
+    get_root_forms = models_db.Character.get_root_forms
+    submissions_filtered = models_db.Character.submissions_filtered
+    get_path_all = staticmethod(models_db.Character.get_path_all)
+    __repr__ = models_db.Character.__repr__
+
+
+class CharacterForm(SubmissionFilterMixin, Record):
+    __slots__ = (
+        "form_id",
+        "form_name",
+        "description",
+        "is_subform",
+        "refsheets",
+        "parent",
+        "children",
+        "character",
+        "species_name",
+        "species",
+        "submissions",
+    )
+
+    slug = models_db.CharacterForm.slug
+    get_friendly_name = models_db.CharacterForm.get_friendly_name
+    get_path = models_db.CharacterForm.get_path
+    __repr__ = models_db.CharacterForm.__repr__
+
+
+# Snapshot
+
+
+class Snapshot(object):
+    """Every record needed to render the site, each kind in get_all order."""
+
+    __slots__ = (
+        "artists",
+        "submissions",
+        "species",
+        "tags",
+        "groups",
+        "characters",
+        "character_forms",
+        "limit_index",
+    )
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs[name])
+
+    @staticmethod
+    def get_all(
+        records: Tuple[Record, ...], limit: Optional[LimitFilter] = None
+    ) -> Tuple[Record, ...]:
+        return tuple(r for r in records if r.is_visible(limit))
+
+
+def build_snapshot(limits: Iterable[LimitFilter]) -> Snapshot:
+    """Copy the imported database into frozen records.
+
+    Visibility masks are precomputed for the given limits. Once this returns
+    nothing reads from the session, so it can be closed.
+    """
+    preloaded = db_helper.preload_render_data()  # noqa: F841
+    index = VisibilityIndex(limits)
+
+    def fields(row, names: Iterable[str]) -> dict:
+        return {name: getattr(row, name) for name in names}
+
+    artist_rows = models_db.Artist.query.order_by(models_db.Artist.name).all()
+    submission_rows = models_db.Submission.query.order_by(
+        models_db.Submission.date.desc()
+    ).all()
+    species_rows = models_db.Species.query.order_by(
+        models_db.Species.species_name
+    ).all()
+    tag_rows = models_db.Tag.query.order_by(models_db.Tag.tag_id).all()
+    group_rows = models_db.Group.query.order_by(models_db.Group.group_name).all()
+    character_rows = models_db.Character.query.order_by(
+        models_db.Character.name
+    ).all()
+    form_rows = models_db.CharacterForm.query.order_by(
+        models_db.CharacterForm.form_id
+    ).all()
+
+    # Scalar columns first, keyed by the row they came from
+    records: Dict[int, Record] = {}
+    for rows, record_class, names in (
+        (artist_rows, Artist, ("name", "links", "path")),
+        (
+            submission_rows,
+            Submission,
+            (
+                "submission_id",
+                "submission_type",
+                "filename",
+                "title",
+                "slug",
+                "date",
+                "description",
+                "visibility",
+                "lockout",
+                "sequence",
+                "my_links",
+                "artist_links",
+            ),
+        ),
+        (species_rows, Species, ("species_name", "description", "softname")),
+        (tag_rows, Tag, ("tag_id", "tag_name", "description", "softname")),
+        (group_rows, Group, ("group_name", "description", "softname")),
+        (
+            character_rows,
+            Character,
+            ("name", "description", "owner", "root", "links"),
+        ),
+        (
+            form_rows,
+            CharacterForm,
+            ("form_id", "form_name", "description", "is_subform", "refsheets"),
+        ),
+    ):
+        for row in rows:
+            records[id(row)] = record_class(**fields(row, names))
+
+    def one(row) -> Optional[Record]:
+        return records[id(row)] if row is not None else None
+
+    def many(rows) -> Tuple[Record, ...]:
+        return tuple(records[id(row)] for row in rows)
+
+    # Submissions of tags etc. come back in insertion order, which changes when
+    # an artist is imported again. Order them by artist, then as listed instead.
+    position: Dict[int, Tuple[int, int]] = {}
+    for artist_index, row in enumerate(artist_rows):
+        for submission_index, submission in enumerate(row.submissions):
+            position[id(submission)] = (artist_index, submission_index)
+
+    def submissions(rows) -> Tuple[Record, ...]:
+        return many(sorted(rows, key=lambda row: position[id(row)]))
+
+    def mask(submissions) -> int:
+        value = 0
+        for row in submissions:
+            value |= index.get_mask(row)
+        return value
+
+    # Then resolve relationships into records
+    for row in artist_rows:
+        one(row)._link(
+            mask=mask(row.submissions),
+            limit_index=index,
+            submissions=many(row.submissions),
+        )
+
+    for row in submission_rows:
+        one(row)._link(
+            mask=index.get_mask(row),
+            limit_index=index,
+            artist=one(row.artist),
+            characters=many(row.characters),
+            tags=many(row.tags),
+            species=many(row.species),
+            groups=many(row.groups),
+        )
+
+    for row in species_rows:
+        one(row)._link(
+            mask=mask(row.submissions),
+            limit_index=index,
+            forms=many(row.forms),
+            submissions=submissions(row.submissions),
+        )
+
+    for row in tag_rows:
+        one(row)._link(
+            mask=mask(row.submissions),
+            limit_index=index,
+            parent=one(row.parent),
+            children=many(row.children),
+            submissions=submissions(row.submissions),
+        )
+
+    for row in group_rows:
+        one(row)._link(
+            mask=mask(row.submissions),
+            limit_index=index,
+            submissions=submissions(row.submissions),
+        )
+
+    for row in character_rows:
+        one(row)._link(
+            mask=mask(s for form in row.forms for s in form.submissions),
+            limit_index=index,
+            forms=many(row.forms),
+        )
+
+    for row in form_rows:
+        one(row)._link(
+            mask=mask(row.submissions),
+            limit_index=index,
+            parent=one(row.parent),
+            children=many(row.children),
+            character=one(row.character),
+            species_name=row.species_name,
+            species=one(row.species),
+            submissions=submissions(row.submissions),
+        )
+
+    return Snapshot(
+        artists=many(artist_rows),
+        submissions=many(submission_rows),
+        species=many(species_rows),
+        tags=many(tag_rows),
+        groups=many(group_rows),
+        characters=many(character_rows),
+        character_forms=many(form_rows),
+        limit_index=index,
+    )
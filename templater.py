@@ -1,21 +1,200 @@
-from jinja2 import Environment, FileSystemLoader, Markup
-from markdown import Markdown
-from mdextensions import InternalLinksExtension
+import os
+import argparse
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Set
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Markup,
+    ModuleLoader,
+    meta,
+)
+import hashing
+from markdown_cache import MarkdownRenderer
+
+
+# Characters of output gathered before handing a chunk on
+CHUNK_SIZE = 64 * 1024
+
+# Template holding the macros whose output is reused
+MACRO_TEMPLATE = "_macros.html"
+
+
+class FragmentCache(object):
+    '''Rendered macro output, reused until the macro template changes.'''
+
+    def __init__(self, templater: "Templater", template_name: str):
+        self.templater = templater
+        self.template_name = template_name
+        self.template = None
+        self.version: Optional[str] = None
+        self.fragments: Dict[Hashable, Markup] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self) -> Any:
+        '''Get the template, forgetting everything if its source changed.
+
+        Looking the template up means a stat with auto_reload, so this is done
+        once per render rather than for every fragment.
+        '''
+        template = self.templater.jinja.get_template(self.template_name)
+        if template is not self.template:
+            source = self.templater.get_source(self.template_name)
+            version = hashing.get_data_hash(source.encode("utf-8"), "blake2b")
+            if version != self.version:
+                self.fragments.clear()
+                self.version = version
+            self.template = template
+        return template
+
+    def render(self, key: Hashable, macro: str, *args, **kwargs) -> Markup:
+        template = self.template
+        if template is None:
+            template = self.refresh()
+        fragment = self.fragments.get(key)
+        if fragment is not None:
+            self.hits += 1
+            return fragment
+
+        self.misses += 1
+        fragment = getattr(template.module, macro)(*args, **kwargs)
+        self.fragments[key] = fragment
+        return fragment
 
 
 class Templater(object):
-    '''Build templates.'''
+    '''Build templates.
+
+    Compiled templates are kept in a bytecode cache under cache_dir, checked
+    against the template source, or loaded from modules precompiled into
+    module_dir. Without auto_reload templates aren't checked for changes once
+    loaded.
+    '''
+
+    def __init__(
+        self,
+        template_dir: str,
+        cache_dir: Optional[str] = None,
+        auto_reload: bool = True,
+        module_dir: Optional[str] = None,
+    ):
+        self.template_dir = template_dir
+        self.markdown = MarkdownRenderer(cache_dir)
 
-    def __init__(self, template_dir: str):
-        self.md = Markdown(extensions=[
-            'markdown.extensions.nl2br',
-            InternalLinksExtension()
-        ])
+        # Sources are always read from the template directory
+        self.sources = FileSystemLoader(template_dir)
 
-        self.jinja = Environment(loader=FileSystemLoader(template_dir))
-        self.jinja.filters["markdown"] = lambda text: Markup(self.md.convert(text))
+        bytecode_cache = None
+        if module_dir:
+            loader = ModuleLoader(module_dir)
+        else:
+            loader = self.sources
+            if cache_dir:
+                bytecode_dir = os.path.join(cache_dir, "templates")
+                os.makedirs(bytecode_dir, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+
+        self.jinja = Environment(
+            loader=loader, auto_reload=auto_reload, bytecode_cache=bytecode_cache
+        )
+        self.jinja.filters["markdown"] = lambda text: Markup(
+            self.markdown.convert(text)
+        )
+
+        self.fragments = FragmentCache(self, MACRO_TEMPLATE)
+        self.jinja.globals["thumbnail"] = self.thumbnail
+
+    def thumbnail(
+        self,
+        submission,
+        thumbnails: dict,
+        limit,
+        rootprefix: str = "",
+        inartistdir: bool = False,
+        titleonly: bool = False,
+    ) -> Markup:
+        '''Render a thumbnail card, once for each way a submission is shown.'''
+        key = (
+            submission.artist.slug(),
+            submission.slug,
+            id(thumbnails),
+            limit,
+            rootprefix,
+            inartistdir,
+            titleonly,
+        )
+        return self.fragments.render(
+            key,
+            "thumbnail_card",
+            submission,
+            thumbnails,
+            limit,
+            rootprefix=rootprefix,
+            inartistdir=inartistdir,
+            titleonly=titleonly,
+        )
 
     def generate(self, template_name: str, **kwargs) -> str:
         '''Generate an output file given the template name and content.'''
         template = self.jinja.get_template("%s.html" % (template_name))
         return template.render(**kwargs)
+
+    def stream(self, template_name: str, **kwargs) -> Iterator[bytes]:
+        '''Generate an output file as encoded chunks, never holding all of it.'''
+        template = self.jinja.get_template("%s.html" % (template_name))
+        buffer = []
+        size = 0
+        for piece in template.generate(**kwargs):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= CHUNK_SIZE:
+                yield "".join(buffer).encode("utf-8")
+                buffer = []
+                size = 0
+        if buffer:
+            yield "".join(buffer).encode("utf-8")
+
+    def list_templates(self) -> List[str]:
+        return self.sources.list_templates()
+
+    def load_all(self) -> None:
+        '''Load every template, so forked workers start with them compiled.'''
+        for name in self.list_templates():
+            self.jinja.get_template(name)
+
+    def compile(self, target: str) -> None:
+        '''Precompile every template into Python modules for module_dir.'''
+        self.jinja.compile_templates(target, zip=None)
+
+    def get_source(self, filename: str) -> str:
+        return self.sources.get_source(self.jinja, filename)[0]
+
+    def get_dependencies(self, filename: str) -> Set[str]:
+        '''Find every template file a template uses, including itself.'''
+        found = set()
+        pending = [filename]
+        while pending:
+            name = pending.pop()
+            if name not in found:
+                found.add(name)
+                parsed = self.jinja.parse(self.get_source(name))
+                # Names only known at render time come back as None
+                pending.extend(
+                    used for used in meta.find_referenced_templates(parsed) if used
+                )
+        return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompile templates for --templateModules"
+    )
+    parser.add_argument(
+        "-t", "--templates", help="Template directory", default="templates"
+    )
+    parser.add_argument("target", help="Directory to write the modules to")
+    args = parser.parse_args()
+
+    Templater(args.templates).compile(args.target)
@@ -0,0 +1,163 @@
+"""Incremental builds must produce the same site as clean ones."""
+
+import os
+import json
+import shutil
+import pytest
+import yaml
+import artsy
+import benchmark
+import importer
+from importer import ConfigFileError
+from manifest import BUILD_FILE_PREFIX
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_tree(path: str) -> dict:
+    """Contents of every output file, leaving out the build's own state."""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.startswith(BUILD_FILE_PREFIX):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            with open(filepath, "rb") as f:
+                files[os.path.relpath(filepath, path)] = f.read()
+    return files
+
+
+def edit_yaml(filename: str, edit) -> None:
+    with open(filename, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+    edit(data)
+    benchmark.write_yaml(filename, data)
+
+
+@pytest.fixture
+def gallery(tmp_path, monkeypatch):
+    # Templates, static files and the database are found in the working
+    # directory
+    monkeypatch.chdir(ROOT)
+    input_dir = str(tmp_path / "input")
+    benchmark.generate_gallery(input_dir, 120, artists=4)
+    return tmp_path, input_dir
+
+
+def build(tmp_path, input_dir: str, output_dir: str, **kwargs) -> dict:
+    artsy.generate_static_site(
+        input_dir,
+        str(tmp_path / output_dir),
+        jobs=1,
+        cache_dir=str(tmp_path / "cache"),
+        **kwargs
+    )
+    return read_tree(str(tmp_path / output_dir))
+
+
+def assert_same_as_clean(tmp_path, input_dir: str, **kwargs) -> None:
+    incremental = build(tmp_path, input_dir, "output", incremental=True, **kwargs)
+    clean = build(tmp_path, input_dir, "clean", force=True, **kwargs)
+    assert sorted(incremental) == sorted(clean)
+    assert [name for name in clean if incremental[name] != clean[name]] == []
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_rebuild_after_changes(gallery, batch):
+    tmp_path, input_dir = gallery
+    build(tmp_path, input_dir, "output", incremental=True, batch=batch)
+
+    def rename_species(data: dict) -> None:
+        data["species_softname"]["species0"] = "Wolfish"
+
+    edit_yaml(os.path.join(input_dir, ".metadata.yaml"), rename_species)
+    benchmark.change_artist_file(input_dir)
+    assert_same_as_clean(tmp_path, input_dir, batch=batch)
+
+    # Without the metadata changing, so only the artist files are imported
+    shutil.move(
+        os.path.join(input_dir, "artist3"), os.path.join(input_dir, "artist3moved")
+    )
+    benchmark.change_artist_file(input_dir)
+    assert_same_as_clean(tmp_path, input_dir, batch=batch)
+
+
+def test_rebuild_after_page_boundaries_move(gallery):
+    tmp_path, input_dir = gallery
+    artist_dir = os.path.join(input_dir, "zartist")
+    os.makedirs(artist_dir)
+
+    # Tags sorting after the generated ones, which end the all-tags pages:
+    # zz0 fills a page, zza and zzm share the next and zzz is on the last
+    def write_artist_file(counts: dict) -> None:
+        files = []
+        for tag, count in counts.items():
+            for i in range(count):
+                slug = "{}-{}".format(tag, i)
+                shutil.copy(
+                    os.path.join(input_dir, "artist0", "image1.png"),
+                    os.path.join(artist_dir, slug + ".png"),
+                )
+                files.append(
+                    {
+                        "filename": slug + ".png",
+                        "title": slug,
+                        "slug": slug,
+                        "date": 20200101,
+                        "tags": [tag],
+                        "characters": [],
+                    }
+                )
+        benchmark.write_yaml(
+            os.path.join(artist_dir, ".art.yaml"),
+            {"artist": {"name": "Z Artist"}, "files": files},
+        )
+
+    write_artist_file({"zz0": 10, "zza": 5, "zzm": 5, "zzz": 5})
+    build(tmp_path, input_dir, "output", incremental=True, page_size=10)
+
+    # Only zza changes, but zzm moves onto the page of zzz
+    write_artist_file({"zz0": 10, "zza": 6, "zzm": 5, "zzz": 5})
+    assert_same_as_clean(tmp_path, input_dir, page_size=10)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_rebuild_after_failed_import(gallery, batch):
+    tmp_path, input_dir = gallery
+    build(tmp_path, input_dir, "output", incremental=True, batch=batch)
+
+    filename = os.path.join(input_dir, "artist1", ".art.yaml")
+    with open(filename, "rb") as f:
+        original = f.read()
+
+    def add_undefined_character(data: dict) -> None:
+        data["files"][10]["characters"] = ["nobody#unknown"]
+
+    edit_yaml(filename, add_undefined_character)
+    with pytest.raises(ConfigFileError):
+        build(tmp_path, input_dir, "output", incremental=True, batch=batch)
+
+    with open(filename, "wb") as f:
+        f.write(original)
+    assert_same_as_clean(tmp_path, input_dir, batch=batch)
+
+
+def test_rebuild_renders_only_affected_pages(gallery):
+    tmp_path, input_dir = gallery
+    build(tmp_path, input_dir, "output", incremental=True)
+
+    # Imported first, so importing it again hands its submissions new IDs
+    def change_title(data: dict) -> None:
+        data["files"][0]["title"] += " (changed)"
+
+    edit_yaml(importer.get_artist_files(input_dir)[0], change_title)
+    report_file = str(tmp_path / "metrics.json")
+    build(
+        tmp_path, input_dir, "output", incremental=True, metrics_file=report_file
+    )
+
+    # The submission's own pages, and the listings and entity pages showing it
+    with open(report_file, "r", encoding="utf-8") as f:
+        counters = json.load(f)["counters"]
+    assert counters["pages_written"] > 0
+    assert counters["pages_rendered"] <= 100
@@ -0,0 +1,136 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from resizeimage import resizeimage
+from PIL import Image
+import metrics
+import utils
+
+if TYPE_CHECKING:
+    from snapshot import Submission
+
+
+def generate_thumbnail_size(img: Image, width: int, filename: str) -> None:
+    thumb = resizeimage.resize_thumbnail(img, [width, width])
+    thumb.save(filename, img.format)
+
+
+def generate_thumbnail_files(source: str, targets: List[Tuple[int, str]]) -> None:
+    '''Generate every requested thumbnail width for a single source image.'''
+    with Image.open(source) as img:
+        for width, filename in targets:
+            generate_thumbnail_size(img, width, filename)
+
+
+class Thumbnailer(object):
+    '''Build thumbnails.'''
+
+    def __init__(self, widths: List[int], jobs: Optional[int] = None):
+        self.widths = widths
+        self.jobs = jobs
+
+        # Pending thumbnail jobs, keyed by destination: (source, width)
+        self.pending: Dict[str, Tuple[str, int]] = {}
+        self.failures: List[Tuple[str, Exception]] = []
+
+        # Thumbnail names for each submission already processed this build
+        self.registry: Dict[int, dict] = {}
+
+    def add(
+        self,
+        indir: str,
+        outdir: str,
+        image: "Submission",
+        do_update: Callable[[str, str], bool],
+        add_touched: Callable[..., None],
+    ) -> dict:
+        '''Copy the full image and queue its thumbnails, returning their names.
+
+        Thumbnails don't depend on the limit, so each submission is only
+        hashed, copied and queued once per build.
+        '''
+        if image.submission_id in self.registry:
+            return self.registry[image.submission_id]
+
+        thumbnails = {}
+        relpath = os.path.join(indir, image.filename)
+
+        def get_path(size: str):
+            return os.path.join(
+                outdir,
+                "{slug}_{size}.{imgext}".format(
+                    size=size, slug=image.slug, imgext=image.get_file_ext()
+                ),
+            )
+
+        # Copy full image file
+        fullpath = get_path("full")
+        fullhash = utils.get_hash(relpath)
+        should_do_update = do_update(fullpath, fullhash)
+        copied = True
+        if should_do_update:
+            try:
+                shutil.copy2(relpath, fullpath)
+                metrics.count("bytes_written", os.path.getsize(fullpath))
+            except OSError as e:
+                self.failures.append((relpath, e))
+                copied = False
+        # Whatever a failed copy left behind doesn't have the source's hash
+        add_touched(fullpath, fullhash if copied else None)
+
+        thumbnails["full"] = os.path.basename(fullpath)
+        thumbnails["_relpath"] = relpath
+
+        # Queue actual thumbnails
+        for width in list(self.widths):
+            filename = get_path(width)
+            if copied and (should_do_update or not os.path.exists(filename)):
+                self.pending[filename] = (relpath, width)
+            thumbnails[width] = os.path.basename(filename)
+            add_touched(filename)
+
+        self.registry[image.submission_id] = thumbnails
+        return thumbnails
+
+    def get(self, image: "Submission") -> Optional[dict]:
+        '''Look up the thumbnail names of an already added submission.'''
+        return self.registry.get(image.submission_id)
+
+    def run(self) -> List[Tuple[str, Exception]]:
+        '''Generate all queued thumbnails, returning any per-image failures.'''
+        # Group by source so each image is only decoded once
+        by_source: Dict[str, List[Tuple[int, str]]] = {}
+        for filename, (source, width) in self.pending.items():
+            by_source.setdefault(source, []).append((width, filename))
+        self.pending = {}
+
+        failures = self.failures
+        self.failures = []
+
+        if self.jobs == 1 or len(by_source) < 2:
+            for source, targets in by_source.items():
+                try:
+                    generate_thumbnail_files(source, targets)
+                    metrics.count("thumbnails_generated", len(targets))
+                except Exception as e:
+                    failures.append((source, e))
+            return failures
+
+        with ProcessPoolExecutor(
+            max_workers=self.jobs,
+            initializer=metrics.start_worker,
+            initargs=("thumbnails:generate",),
+        ) as executor:
+            futures = {
+                executor.submit(generate_thumbnail_files, source, targets): source
+                for source, targets in by_source.items()
+            }
+            for future, source in futures.items():
+                try:
+                    future.result()
+                    metrics.count("thumbnails_generated", len(by_source[source]))
+                except Exception as e:
+                    failures.append((source, e))
+
+        return failures
@@ -3,10 +3,26 @@ import re
 import glob
 import json
 import argparse
-import binascii
+from contextlib import contextmanager
 import attr
 import cattr
-from typing import Any, Optional, Dict, List, Iterable
+from sqlalchemy import and_, or_, true
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Optional,
+    Dict,
+    Iterator,
+    List,
+    Iterable,
+)
+import hashing
+
+if TYPE_CHECKING:
+    # models_db imports this module
+    from models_db import Submission
 
 
 clean_string_regex = re.compile("[^a-zA-Z0-9]")
@@ -20,11 +36,45 @@ def remove_parent_path(parent: str, filepath: str) -> str:
     return filepath[len(parent) + 1 :]
 
 
-def get_hash(infile: str) -> str:
-    if not os.path.exists(infile):
-        return None
+def get_data_hash(data: bytes) -> str:
+    return hashing.get_data_hash(data)
 
-    return "%08X" % (binascii.crc32(open(infile, "rb").read()) & 0xFFFFFFFF)
+
+def get_hash(infile: str) -> Optional[str]:
+    return hashing.get_file_hash(infile)
+
+
+@contextmanager
+def open_atomic(
+    outfile: str,
+    mode: str = "wb",
+    keep: Optional[Callable[[], bool]] = None,
+    **kwargs
+) -> Iterator[IO]:
+    """Open a temporary file that's renamed over outfile once written.
+
+    Readers never see half a file, and nothing is left behind when writing
+    fails. With keep, outfile is only replaced if keep() is true once the
+    file is written.
+    """
+    tmpfile = "{}.{}.tmp".format(outfile, os.getpid())
+    try:
+        with open(tmpfile, mode, **kwargs) as f:
+            yield f
+        if keep is None or keep():
+            os.replace(tmpfile, outfile)
+        else:
+            os.unlink(tmpfile)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+
+
+def write_atomic(outfile: str, data: bytes) -> None:
+    """Write via a temporary file and rename, so readers never see half a file."""
+    with open_atomic(outfile) as f:
+        f.write(data)
 
 
 def get_dir_hashes(indir: str) -> Dict[str, str]:
@@ -52,7 +102,10 @@ def write_json(outfile: str, data: Any, clean: bool = False) -> None:
 
 
 def build_filename(
-    name: str, extension: str = "html", limit: Optional["LimitFilter"] = None
+    name: str,
+    extension: str = "html",
+    limit: Optional["LimitFilter"] = None,
+    page: int = 1,
 ) -> str:
     outstr = name
 
@@ -62,11 +115,21 @@ def build_filename(
         if limit.lockout:
             outstr = "{}_{}".format(outstr, limit.lockout)
 
+    # The first page keeps the plain name, so links to it don't change
+    if page > 1:
+        outstr = "{}_page{}".format(outstr, page)
+
     outstr = "{}.{}".format(outstr, extension)
 
     return outstr
 
 
+def get_limit_name(limit: Optional["LimitFilter"]) -> str:
+    """Name a limit the way its filenames are suffixed, for reports."""
+    parts = [limit.visibility, limit.lockout] if limit else []
+    return "_".join(part for part in parts if part) or "public"
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -94,6 +157,92 @@ def parse_args():
     parser.add_argument(
         "-f", "--force", help="Force rewrite content", action="store_true"
     )
+    parser.add_argument(
+        "--incremental",
+        help="Keep the metadata database between runs and only import changed files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch",
+        help="Bulk insert artist files in a single transaction",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes (defaults to the CPU count)",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--pageSize",
+        help="Split listings into pages of at most N submissions",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--noTemplateReload",
+        help="Don't check templates for changes each time they're used",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--templateModules",
+        help="Load templates precompiled with templater.py from a directory",
+        default=None,
+        metavar="MODULE_DIR",
+    )
+    parser.add_argument(
+        "--watch",
+        help="Keep running and rebuild affected pages when inputs change",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--hashAlgorithm",
+        help="Algorithm used to detect changed files",
+        choices=sorted(hashing.ALGORITHMS),
+        default=hashing.DEFAULT_ALGORITHM,
+    )
+    parser.add_argument(
+        "--cacheDir",
+        help="Directory for caches kept between builds",
+        default=".artsy-cache",
+        metavar="CACHE_DIR",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write phase timings, counters and render times to a JSON file",
+        default=None,
+        metavar="FILENAME",
+    )
+    parser.add_argument(
+        "--trace",
+        help="Write phase timings as a Chrome trace event file",
+        default=None,
+        metavar="FILENAME",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile each build phase with cProfile, writing pstats files",
+        default=None,
+        metavar="PROFILE_DIR",
+    )
+    parser.add_argument(
+        "--profileMemory",
+        help="Find the top allocation sites of each build phase",
+        default=None,
+        metavar="PROFILE_DIR",
+    )
+    parser.add_argument(
+        "--bind",
+        help="Address selfhost.py listens on",
+        default="",
+        metavar="ADDRESS",
+    )
+    parser.add_argument(
+        "--port", help="Port selfhost.py listens on", type=int, default=8000
+    )
     parser.add_argument(
         "-c", "--config", help="Configuration file", default=None, metavar="FILENAME"
     )
@@ -117,6 +266,36 @@ def parse_args():
                 args.lockoutOnly = config["lockoutOnly"]
             if "force" in config:
                 args.force = config["force"]
+            if "incremental" in config:
+                args.incremental = config["incremental"]
+            if "batch" in config:
+                args.batch = config["batch"]
+            if "jobs" in config:
+                args.jobs = config["jobs"]
+            if "pageSize" in config:
+                args.pageSize = config["pageSize"]
+            if "noTemplateReload" in config:
+                args.noTemplateReload = config["noTemplateReload"]
+            if "templateModules" in config:
+                args.templateModules = config["templateModules"]
+            if "watch" in config:
+                args.watch = config["watch"]
+            if "hashAlgorithm" in config:
+                args.hashAlgorithm = config["hashAlgorithm"]
+            if "cacheDir" in config:
+                args.cacheDir = config["cacheDir"]
+            if "metrics" in config:
+                args.metrics = config["metrics"]
+            if "trace" in config:
+                args.trace = config["trace"]
+            if "profile" in config:
+                args.profile = config["profile"]
+            if "profileMemory" in config:
+                args.profileMemory = config["profileMemory"]
+            if "bind" in config:
+                args.bind = config["bind"]
+            if "port" in config:
+                args.port = config["port"]
 
     if not args.indir:
         raise RuntimeError("Missing input directory.")
@@ -149,10 +328,54 @@ class LimitFilter(object):
     def filter(self, subs: List["Submission"]) -> Iterable["Submission"]:
         return filter(lambda f: self.is_visible(f), subs)
 
+    def get_clause(self, visibility_column, lockout_column):
+        """Build a SQL expression matching the same rows as is_visible."""
+
+        def match(column, value, only):
+            if value == "*":
+                return true()
+
+            # Comparing against None compiles to IS NULL
+            clause = column == value
+            if not only and value is not None:
+                clause = or_(clause, column.is_(None))
+            return clause
+
+        return and_(
+            match(visibility_column, self.visibility, self.visibilityOnly),
+            match(lockout_column, self.lockout, self.lockoutOnly),
+        )
+
     def get_path_name(self, name: str, extension: Optional[str]) -> str:
         return build_filename(name, extension, self)
 
 
+class VisibilityIndex(object):
+    """Give each limit a bit, so visibility under all of them fits in one int."""
+
+    def __init__(self, limits: Iterable[LimitFilter]):
+        self.bits: Dict[LimitFilter, int] = {
+            limit: 1 << i for i, limit in enumerate(limits)
+        }
+
+        # Masks only depend on the (visibility, lockout) pair
+        self._masks: Dict[tuple, int] = {}
+
+    def get_bit(self, limit: Optional[LimitFilter]) -> Optional[int]:
+        return self.bits.get(limit) if limit else None
+
+    def get_mask(self, f: "Submission") -> int:
+        key = (f.visibility, f.lockout)
+        if key not in self._masks:
+            mask = 0
+            for limit, bit in self.bits.items():
+                if limit.is_visible(f):
+                    mask |= bit
+            self._masks[key] = mask
+
+        return self._masks[key]
+
+
 def get_limit_from_args(args) -> LimitFilter:
     return LimitFilter(
         visibility=args.visibility,
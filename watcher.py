@@ -0,0 +1,110 @@
+"""Wait for files to change under a set of directories."""
+
+import os
+import time
+from typing import Dict, Iterable, Set, Tuple
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class PollingWatcher(object):
+    '''Find changes by comparing the stat data of every file.'''
+
+    def __init__(self, paths: Iterable[str], interval: float = 1.0):
+        self.paths = list(paths)
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        state = {}
+        for path in self.paths:
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    filepath = os.path.join(root, name)
+                    try:
+                        stat = os.stat(filepath)
+                    except FileNotFoundError:
+                        continue
+                    state[filepath] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def wait(self) -> Set[str]:
+        '''Block until files are added, changed or removed and return them.'''
+        while True:
+            time.sleep(self.interval)
+            state = self.scan()
+            changed = {
+                path
+                for path in state.keys() | self.state.keys()
+                if state.get(path) != self.state.get(path)
+            }
+            self.state = state
+            if changed:
+                return changed
+
+
+class InotifyWatcher(object):
+    '''Find changes from inotify events, watching new directories as they appear.'''
+
+    def __init__(self, paths: Iterable[str], delay: float = 0.2):
+        flags = inotify_simple.flags
+        self.mask = (
+            flags.CREATE
+            | flags.CLOSE_WRITE
+            | flags.DELETE
+            | flags.MOVED_FROM
+            | flags.MOVED_TO
+        )
+        self.delay = delay
+        self.inotify = inotify_simple.INotify()
+
+        # Watch descriptor: directory
+        self.dirs: Dict[int, str] = {}
+        for path in paths:
+            self.add_tree(path)
+
+    def add_tree(self, path: str) -> Set[str]:
+        '''Watch a directory and everything below it, returning the files in it.'''
+        found = set()
+        for root, dirs, files in os.walk(path):
+            self.dirs[self.inotify.add_watch(root, self.mask)] = root
+            found.update(os.path.join(root, name) for name in files)
+        return found
+
+    def wait(self) -> Set[str]:
+        '''Block until files are added, changed or removed and return them.'''
+        flags = inotify_simple.flags
+        changed: Set[str] = set()
+        while not changed:
+            # Editors save in several steps, so let the events settle first
+            events = self.inotify.read(read_delay=int(self.delay * 1000))
+            for event in events:
+                if event.mask & flags.IGNORED:
+                    self.dirs.pop(event.wd, None)
+                    continue
+
+                root = self.dirs.get(event.wd)
+                if root is None or not event.name:
+                    continue
+
+                path = os.path.join(root, event.name)
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        changed.update(self.add_tree(path))
+                else:
+                    changed.add(path)
+
+        return changed
+
+
+def get_watcher(paths: Iterable[str]):
+    '''Watch with inotify where it's available, polling otherwise.'''
+    if inotify_simple is not None:
+        try:
+            return InotifyWatcher(paths)
+        except OSError:
+            pass
+    return PollingWatcher(paths)